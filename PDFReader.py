@@ -11,6 +11,8 @@ import json
 import os
 import re
 
+from ratelimit import openai_scheduler, estimate_tokens
+
 
 class Recommender:
     def __init__(self, search_assistant_id=None, normal_assistant_id=None):
@@ -61,8 +63,9 @@ class Recommender:
     def execute_normal_agent(self, text_input):
         if not self.normal_assistant_id:
             raise AttributeError("Normal Assistant not found")
-        response = self.normal_agent.invoke(
-            {"content": text_input, "thread_id": self.normal_thread_id}
+        response = self.invoke_agent(
+            self.normal_agent,
+            {"content": text_input, "thread_id": self.normal_thread_id},
         )
         print(response.return_values["output"])
 
@@ -85,7 +88,7 @@ class Recommender:
         input["thread_id"] = self.search_thread_id
         tool_map = {tool.name: tool for tool in self.tools}
 
-        response = self.search_agent.invoke(input)
+        response = self.invoke_agent(self.search_agent, input)
         # 如果response返回type是找餐馆，call serpapiWarapper.SearchRestaurant
         # 如果response返回type是找酒店，call serpapiWarapper.SearchHotel
         # 如果response返回type是找航班，call serpapiWarapper.SearchFlight
@@ -98,12 +101,13 @@ class Recommender:
                 tool_outputs.append(
                     {"output": origin_webs, "tool_call_id": action.tool_call_id}
                 )
-            response = self.search_agent.invoke(
+            response = self.invoke_agent(
+                self.search_agent,
                 {
                     "tool_outputs": tool_outputs,
                     "run_id": action.run_id,
                     "thread_id": self.search_thread_id,
-                }
+                },
             )
 
         # Eliminate possible reasoning texts
@@ -114,6 +118,13 @@ class Recommender:
         return webs_json  # 注意这里不要把origin_webs返回, 返回最终结果
         # return response.return_values["output"]
 
+    def invoke_agent(self, agent, input):
+        """
+        Run an assistant call once the rate limits shared with ChatRecommender allow it
+        """
+        openai_scheduler.acquire_sync("recommend", estimate_tokens(str(input)))
+        return agent.invoke(input)
+
     def handle_search_result(self, result):
         """
         Handle the search result from Google Serper API.
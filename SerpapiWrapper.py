@@ -1,20 +1,72 @@
 import asyncio
 import os
 import json
-from serpapi import GoogleSearch
+import httpx
 from dotenv import load_dotenv
 
+from deadline import timeout_of
+from hedge import hedged
+from utility import JsonProjection
+
+# Fields of each engine used by the extractors, with the number of entries they read
+PROJECTIONS = {
+    "google_hotels": {"search_metadata": None, "properties": 3},
+    "google_flights": {"search_metadata": None, "best_flights": 1, "other_flights": 1},
+    "google_local": {"search_metadata": None, "local_results": 3},
+}
+
 # import keyboard
 # import sockettest
 # from sockettest import send_message_once
 
 
 class SerpapiWrapper:
-    def __init__(self):
-        self.base_url = "https://serpapi.com/search?engine="
+    def __init__(self, cache=None, max_concurrency=8, timeout=20, hedger=None):
+        """
+        cache: SearchCache of the responses, None to always search
+        hedger: Hedger for slow searches, None to disable hedging
+        max_concurrency: max number of pooled connections
+        timeout: seconds for each http request when the request has no deadline
+        """
+        self.base_url = "https://serpapi.com/search.json"
         self.api_key = os.getenv("SERPAPI_API_KEY")
-
-    def SearchHotel(self, query, check_in, check_out, min_price=None, max_price=None):
+        self.cache = cache
+        self.hedger = hedger
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.client = None  # created in the running event loop, see get_client()
+        self.drains = set()  # tasks reading the unparsed rest of responses
+
+    def get_client(self):
+        """
+        Shared client, hotel, flight and restaurant searches reuse its connections
+        """
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                    keepalive_expiry=60,
+                ),
+            )
+        return self.client
+
+    async def close(self):
+        drains = list(self.drains)
+        for task in drains:
+            task.cancel()
+        await asyncio.gather(*drains, return_exceptions=True)
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def SearchHotel(
+        self, query, check_in, check_out, min_price=None, max_price=None, *, deadline=None
+    ):
+        """
+        deadline: Deadline of the request, used as timeout of the http requests
+        """
         if min_price == "None":
             min_price = None
         if max_price == "None":
@@ -33,9 +85,7 @@ class SerpapiWrapper:
             "min_price": min_price,
             "max_price": max_price,
         }
-        search = GoogleSearch(params)
-
-        data = json.loads(search.get_raw_json())
+        data = await self.fetch(params, deadline)
         link = self.GetHotelLink(data)
         combined_results = {"link": link, "hotels": self.GetHotelResult(data)}
         # return data['search_metadata']['prettify_html_file']
@@ -48,7 +98,9 @@ class SerpapiWrapper:
         # send_message_once(json_str)
         return formatted_output
 
-    def SearchFlight(self, _departure_id, _arrival_id, _outbound_date, _return_date):
+    async def SearchFlight(
+        self, _departure_id, _arrival_id, _outbound_date, _return_date, *, deadline=None
+    ):
         params = {
             "engine": "google_flights",
             "hl": "en",
@@ -62,9 +114,7 @@ class SerpapiWrapper:
             "return_date": _return_date,
             "deep_search": True,
         }
-        search = GoogleSearch(params)
-        outbound_data = json.loads(search.get_raw_json())
-        link = self.GetFlightLink(outbound_data)
+        outbound_data = await self.fetch(params, deadline)
         depature_token = outbound_data["best_flights"][0]["departure_token"]
         return_params = {
             "engine": "google_flights",
@@ -79,10 +129,15 @@ class SerpapiWrapper:
             "return_date": _return_date,
             "departure_token": depature_token,
         }
-        return_search = GoogleSearch(return_params)
-        return_data = json.loads(return_search.get_raw_json())
-        refine_outbound_data = self.GetFlightResult(outbound_data)
-        # print(refine_outbound_data)
+        # The return search only needs the token, start it before parsing the outbound
+        return_search = asyncio.ensure_future(self.fetch(return_params, deadline))
+        try:
+            link = self.GetFlightLink(outbound_data)
+            refine_outbound_data = self.GetFlightResult(outbound_data)
+            # print(refine_outbound_data)
+            return_data = await return_search
+        finally:
+            return_search.cancel()
         refine_return_data = self.GetFlightResult(return_data)
         # print(refine_return_data)
         combined_results = {
@@ -99,7 +154,7 @@ class SerpapiWrapper:
         # json_str = json.dumps(formatted_output)
         return formatted_output
 
-    def SearchRestaurant(self, query):
+    async def SearchRestaurant(self, query, *, deadline=None):
         finalquery = query + " restaurant"
         params = {
             "engine": "google_local",
@@ -109,8 +164,7 @@ class SerpapiWrapper:
             "api_key": self.api_key,
             "q": finalquery,
         }
-        search = GoogleSearch(params)
-        data = json.loads(search.get_raw_json())
+        data = await self.fetch(params, deadline)
         link = self.GetRestaurantLink(data)
         combined_results = {
             "link": link,
@@ -127,6 +181,67 @@ class SerpapiWrapper:
         # json_str = json.dumps(formatted_output)
         return formatted_output
 
+    async def fetch(self, params, deadline=None):
+        """
+        return: decoded response of the search, from the cache if the same search was made
+        """
+        engine = params["engine"]
+        if self.cache:
+            data = await self.cache.aget_result(engine, params)
+            if data is not None:
+                return data
+        data = await hedged(
+            self.hedger, f"serpapi/{engine}", lambda: self.get_json(params, deadline)
+        )
+        # Failed searches come back with an error field, do not keep them
+        if self.cache and "error" not in data:
+            await self.cache.aput_result(engine, params, data)
+        return data
+
+    async def get_json(self, params, deadline=None):
+        """
+        Parse the response while it arrives, keep only the fields in PROJECTIONS
+        return: the projected response
+        """
+        client = self.get_client()
+        request = client.build_request(
+            "GET",
+            self.base_url,
+            params={
+                name: str(value).lower() if isinstance(value, bool) else value
+                for name, value in params.items()
+                if value is not None
+            },
+            timeout=timeout_of(deadline, self.timeout),
+        )
+        response = await client.send(request, stream=True)
+        projection = JsonProjection(PROJECTIONS[params["engine"]], optional=["error"])
+        chunks = response.aiter_text()
+        try:
+            async for text in chunks:
+                if projection.feed(text):
+                    break
+            data = projection.finish()
+        except BaseException:
+            await response.aclose()
+            raise
+        # Read the rest without parsing it, so the connection can be reused
+        task = asyncio.ensure_future(self.drain(response, chunks))
+        self.drains.add(task)
+        task.add_done_callback(self.drains.discard)
+        if "error" not in data:
+            response.raise_for_status()
+        return data
+
+    async def drain(self, response, chunks):
+        try:
+            async for _ in chunks:
+                pass
+        except httpx.HTTPError:
+            pass
+        finally:
+            await response.aclose()
+
     def GetHotelLink(self, data):
         return data["search_metadata"]["prettify_html_file"]
 
@@ -246,9 +361,119 @@ class SerpapiWrapper:
 
 
 if __name__ == "__main__":
+    import sys
+    import time
+    import tracemalloc
+
+    def benchmark_projection(rounds=50, chunk_size=16384):
+        """
+        Compare full parsing with projected streaming parsing of a hotel response,
+        built by scaling up the organic results in example_serper.json
+        """
+        with open("example_serper.json", "r", encoding="utf-8") as file:
+            organic = json.load(file)
+        properties = []
+        for i in range(60):
+            item = organic[i % len(organic)]
+            properties.append(
+                {
+                    "name": item["title"],
+                    "description": item["snippet"] * 4,
+                    "link": item["link"],
+                    "rate_per_night": {"lowest": f"¥{10000 + i}"},
+                    "overall_rating": 4.0,
+                    "images": [
+                        {"thumbnail": f"{item['link']}?t={j}", "original_image": item["link"]}
+                        for j in range(20)
+                    ],
+                    "nearby_places": [{"name": o["title"], "snippet": o["snippet"]} for o in organic],
+                }
+            )
+        text = json.dumps(
+            {
+                "search_metadata": {"prettify_html_file": "https://serpapi.com/hotels.html"},
+                "search_parameters": {"engine": "google_hotels", "q": "Tokyo"},
+                "brands": [{"name": o["title"], "children": organic} for o in organic],
+                "properties": properties,
+                "serpapi_pagination": {"next": "https://serpapi.com/next"},
+            },
+            ensure_ascii=False,
+        )
+        chunks = [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
+        serpapi = SerpapiWrapper()
+
+        def full():
+            return serpapi.GetHotelResult(json.loads(text))
+
+        def projected():
+            projection = JsonProjection(PROJECTIONS["google_hotels"], optional=["error"])
+            for chunk in chunks:
+                if projection.feed(chunk):
+                    break
+            return serpapi.GetHotelResult(projection.finish())
+
+        assert full() == projected()
+        print(f"Hotel response of {len(text) / 1024:.0f} KB in {len(chunks)} chunks")
+        for name, parse in [("full", full), ("projected", projected)]:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                parse()
+            elapsed = (time.perf_counter() - start) / rounds
+            tracemalloc.start()
+            parse()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{name}: {elapsed * 1000:.2f} ms, peak memory {peak / 1024:.0f} KB")
+
+    def test_projection():
+        """
+        Projected streaming parsing must equal full parsing at any chunk size,
+        also for responses without a projected field and with a large value after it
+        """
+        fields = PROJECTIONS["google_flights"]
+        cases = 0
+        for padding in range(0, 42 * 977, 977):
+            flights = [{"price": i, "flights": [{"airline": "x" * 50}]} for i in range(3)]
+            responses = [
+                {  # no other_flights
+                    "search_metadata": {"id": "1"},
+                    "best_flights": flights,
+                    "price_insights": {"history": "p" * (padding + 20000)},
+                },
+                {  # return leg without best_flights
+                    "search_metadata": {"id": "2"},
+                    "other_flights": flights,
+                    "price_insights": {"history": "p" * padding},
+                },
+                {"error": "Google hasn't returned any results for this query."},
+            ]
+            for response in responses:
+                text = json.dumps(response)
+                expected = {
+                    key: value[:fields[key]] if isinstance(value, list) else value
+                    for key, value in response.items()
+                    if key in fields or key == "error"
+                }
+                for chunk_size in [1024, 4096, 16384]:
+                    projection = JsonProjection(fields, optional=["error"])
+                    for i in range(0, len(text), chunk_size):
+                        if projection.feed(text[i : i + chunk_size]):
+                            break
+                    assert projection.finish() == expected, (padding, chunk_size)
+                    cases += 1
+        print(f"Projection matches full parsing in {cases} cases")
+
+    if "--test" in sys.argv:
+        test_projection()
+        sys.exit()
+
+    if "--benchmark" in sys.argv:
+        benchmark_projection()
+        sys.exit()
+
     load_dotenv("key.env")
     serpapi = SerpapiWrapper()
-    result = serpapi.SearchHotel("Tokyo", "2025-10-10", "2025-10-11")
+    result = asyncio.run(serpapi.SearchHotel("Tokyo", "2025-10-10", "2025-10-11"))
     # with open("test.json", "r", encoding="utf-8") as file:
     #     data = json.load(file)
     # result = serpapi.SearchFlight("HND","AUS","2025-10-10","2025-10-11")
@@ -1,46 +1,232 @@
-import requests
+import httpx
 import json
 import os
+import random
+import time
 from dotenv import load_dotenv
 import asyncio
 
+from deadline import timeout_of
+from hedge import hedged
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
 
 class SerperWrapper:
-    def __init__(self):
+    def __init__(
+        self,
+        base_url="https://google.serper.dev/search",
+        max_concurrency=8,
+        timeout=10,
+        retries=2,
+        backoff=0.2,
+        batch_size=10,
+        cache=None,
+        hedger=None,
+    ):
+        """
+        base_url: serper endpoint, can point to a local stand-in server for testing
+        max_concurrency: max number of requests and pooled connections at the same time
+        timeout: seconds for each http request when the request has no deadline
+        retries: extra attempts after a connection error or a retryable status
+        backoff: base delay of the retries, doubled each attempt with random jitter
+        batch_size: max number of queries packed into one request
+        cache: SearchCache of the responses, None to always search
+        hedger: Hedger for slow single queries, None to disable hedging
+        """
         load_dotenv()
         self.api_key = os.getenv("SERPER_API_KEY")
-        self.base_url = "https://google.serper.dev/search"
-        self.headers = {"X-API-KEY": self.api_key, "Content-Type": "application/json"}
+        self.base_url = base_url
+        self.headers = {
+            "X-API-KEY": self.api_key or "",
+            "Content-Type": "application/json",
+        }
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self.cache = cache
+        self.hedger = hedger
+        self.client = None  # created in the running event loop, see get_client()
+        self.semaphore = None
 
-    async def post_all_questions(self, questions):
+    def get_client(self):
+        """
+        Shared client, its connections are kept alive between questions
+        """
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                headers=self.headers,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                    keepalive_expiry=60,
+                ),
+            )
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def post_all_questions(self, questions, deadline=None, batch=True):
         """
         Post all questions to the serper api and return the responses.
+        deadline: Deadline of the request, used as timeout of the http requests
+        batch: pack the questions into requests of batch_size queries, else one request per question
         return: a list contains the first websites of each question.
         """
-        loop = asyncio.get_event_loop()
-        tasks = [
-            loop.run_in_executor(None, self.search_one, question)
-            for question in questions
-        ]
-        responses = await asyncio.gather(*tasks)
+        if batch:
+            chunks = [
+                questions[i : i + self.batch_size]
+                for i in range(0, len(questions), self.batch_size)
+            ]
+            tasks = [self.search_batch(chunk, deadline) for chunk in chunks]
+            responses = [
+                website for chunk in await asyncio.gather(*tasks) for website in chunk
+            ]
+        else:
+            tasks = [self.search_one(question, deadline) for question in questions]
+            responses = await asyncio.gather(*tasks)
         print("All questions are acquired:")
         for website in responses:
             print(website["title"])
         return responses
 
-    def search_one(self, question):
-        response = self.post_request(question)
+    async def search_batch(self, questions, deadline=None):
+        """
+        Search several questions in one request, questions whose result is
+        missing or broken are searched again one by one.
+        return: the first websites of the questions, in the same order
+        """
+        payloads = [self.query_payload(question) for question in questions]
+        responses = await asyncio.gather(
+            *[self.cached_response(payload) for payload in payloads]
+        )
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            try:
+                posted = await self.post_payload(
+                    [payloads[i] for i in missing], deadline
+                )
+            except (httpx.HTTPError, ValueError) as e:
+                print(f"Batch of {len(missing)} serper queries failed: {e!r}")
+                posted = []
+            if not isinstance(posted, list):
+                posted = []
+            for i, response in zip(missing, posted):
+                responses[i] = response
+
+        websites = [None] * len(questions)
+        retry = []
+        for i, response in enumerate(responses):
+            try:
+                websites[i] = self.extract_first_website(response)
+            except (KeyError, IndexError, TypeError):
+                retry.append(i)
+                continue
+            if i in missing:
+                await self.save_response(payloads[i], response)
+        if retry:
+            print(f"Search {len(retry)} of {len(questions)} serper queries again")
+            results = await asyncio.gather(
+                *[self.search_one(questions[i], deadline) for i in retry]
+            )
+            for i, website in zip(retry, results):
+                websites[i] = website
+        return websites
+
+    async def search_queue(self, questions, on_website, deadline=None):
+        """
+        Search questions while they are generated, e.g. parsed from a streamed completion.
+        The questions queued while a batch is searched are sent together as the next batch.
+        questions: asyncio.Queue of questions, None ends it
+        on_website: called with the first website of each question, in queue order
+        return: the first websites of all questions
+        """
+        websites = []
+        ended = False
+        while not ended:
+            batch = [await questions.get()]
+            while not questions.empty() and len(batch) < self.batch_size:
+                batch.append(questions.get_nowait())
+            ended = None in batch
+            batch = [question for question in batch if question is not None]
+            if not batch:
+                continue
+            for website in await self.search_batch(batch, deadline):
+                on_website(website)
+                websites.append(website)
+        return websites
+
+    async def search_one(self, question, deadline=None):
+        """
+        return: the first website of the question
+        """
+        payload = self.query_payload(question)
+        response = await self.cached_response(payload)
+        if response is None:
+            response = await hedged(
+                self.hedger, "serper", lambda: self.post_payload(payload, deadline)
+            )
+            website = self.extract_first_website(response)
+            await self.save_response(payload, response)
+            return website
         return self.extract_first_website(response)
 
-    def post_request(self, query):
-        payload = {
+    async def post_request(self, query, deadline=None):
+        return await self.post_payload(self.query_payload(query), deadline)
+
+    def query_payload(self, query):
+        return {
             "q": query,
             "num": 10,
         }
-        response = requests.post(
-            self.base_url, headers=self.headers, data=json.dumps(payload)
-        )
-        return response.json()
+
+    async def cached_response(self, payload):
+        if self.cache is None:
+            return None
+        return await self.cache.aget_result("serper", payload)
+
+    async def save_response(self, payload, response):
+        if self.cache:
+            await self.cache.aput_result("serper", payload, response)
+
+    async def post_payload(self, payload, deadline=None):
+        """
+        payload: a query object, or a list of them for a batch
+        return: decoded response, a list for a batch
+        """
+        client = self.get_client()
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    response = await client.post(
+                        self.base_url,
+                        content=json.dumps(payload),
+                        timeout=timeout_of(deadline, self.timeout),
+                    )
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    return response.json()
+                error = httpx.HTTPStatusError(
+                    f"Status {response.status_code}",
+                    request=response.request,
+                    response=response,
+                )
+            except httpx.TransportError as e:
+                error = e
+            if attempt == self.retries:
+                raise error
+            delay = self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+            if deadline and deadline.remaining() < delay:
+                raise error
+            print(f"Retry serper request in {delay:.2f}s: {error!r}")
+            await asyncio.sleep(delay)
 
     def extract_first_website(self, response):
         first_website = response["organic"][0]
@@ -50,3 +236,84 @@ class SerperWrapper:
             "snippet": first_website["snippet"],
         }
         return info
+
+
+async def run_stand_in(port=8765, latency=0.02):
+    """
+    Local stand-in of the serper endpoint, answers every query with example_serper.json
+    and a batch of queries with a list of such results
+    """
+    with open("example_serper.json", "r", encoding="utf-8") as file:
+        result = {"organic": json.load(file)}
+
+    async def serve(reader, writer):
+        try:
+            while True:  # keep-alive, several requests per connection
+                headers = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in headers.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":")[1])
+                payload = json.loads(await reader.readexactly(length))
+                if isinstance(payload, list):
+                    body = json.dumps([result] * len(payload)).encode("utf-8")
+                else:
+                    body = json.dumps(result).encode("utf-8")
+                await asyncio.sleep(latency)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode()
+                    + body
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    return await asyncio.start_server(serve, "127.0.0.1", port)
+
+
+if __name__ == "__main__":
+    # Benchmark per-query latency: warm pooled client against a new connection per query
+    import requests
+
+    async def benchmark(rounds=50):
+        server = await run_stand_in()
+        serper = SerperWrapper(base_url="http://127.0.0.1:8765/search")
+        loop = asyncio.get_event_loop()
+
+        def legacy_search(question):
+            response = requests.post(
+                serper.base_url,
+                headers=serper.headers,
+                data=json.dumps({"q": question, "num": 10}),
+            )
+            return serper.extract_first_website(response.json())
+
+        await serper.search_one("warm up")
+        for name, search in [
+            ("pooled", lambda q: serper.search_one(q)),
+            ("legacy", lambda q: loop.run_in_executor(None, legacy_search, q)),
+        ]:
+            times = []
+            for i in range(rounds):
+                start = time.perf_counter()
+                await search(f"question {i}")
+                times.append(time.perf_counter() - start)
+            times.sort()
+            print(
+                f"{name}: median {times[len(times) // 2] * 1000:.2f} ms, "
+                f"p95 {times[int(len(times) * 0.95)] * 1000:.2f} ms"
+            )
+
+        questions = [f"keyword {i}" for i in range(5)]
+        for batch in [True, False]:
+            start = time.perf_counter()
+            for _ in range(rounds // 5):
+                await serper.post_all_questions(questions, batch=batch)
+            elapsed = (time.perf_counter() - start) / (rounds // 5)
+            name = "batched" if batch else "per-query"
+            print(f"{name} {len(questions)} questions: {elapsed * 1000:.2f} ms")
+        await serper.close()
+        server.close()
+
+    asyncio.run(benchmark())
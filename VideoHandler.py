@@ -1,27 +1,44 @@
 from openai import OpenAI
 from dotenv import load_dotenv
-import webvtt
 from datetime import datetime, time
-from functools import reduce
 import json
 from chat import ChatRecommender
 from utility import extract_json_array
+from transcript import (
+    CompiledTranscript,
+    IntervalIndex,
+    clean_text,
+    format_ms,
+    load_keywords,
+    to_ms,
+)
+from prefetch import KeywordPrefetcher
+
+MAX_GAP = 2000  # ms, a time between captions takes the previous caption
+KEYWORD_BYTES = 300  # rough memory of the cached keywords of one caption
 
 
-# TODO: add cache for transcript
 class VideoHandler:
     def __init__(self, recommender, vtt_path, section_split=None):
         self.section_recommend = []  # list of TimeSpan for each section
-        self.vtt = webvtt.read(vtt_path)
-        self.transcripts = (
-            self.read_transcripts()
-        )  # list of TimeSpan for each transcript
+        # captions sorted by start, from the compiled cache next to the vtt
+        self.transcripts = CompiledTranscript.load(vtt_path)
         if section_split:
             self.section_recommend = self.read_sections(section_split)
+        self.section_index = IntervalIndex.from_spans(self.section_recommend)
 
         self.last_section = None  # used to compare if the section span has changed
 
         self.recommender = recommender
+        # caption position -> keywords, from precompute_keywords.py, requests and prefetch
+        self.keywords = load_keywords(
+            vtt_path, self.transcripts.digest, recommender.prompt_hash("video")
+        )
+        if self.keywords:
+            print(f"Loaded precomputed keywords of {len(self.keywords)} captions")
+        self.keyword_hits = 0
+        self.keyword_misses = 0
+        self.prefetcher = KeywordPrefetcher(self)
 
         # Generate auto recommendation contents
         # for section in self.section_recommend:
@@ -35,23 +52,28 @@ class VideoHandler:
         return: list of TimeSpan objects for each section
         """
         sections = []
+        texts = []  # captions of each section, joined once at the end
         index = -1
 
         last_end_time = None
-        for caption in self.vtt:
-            start_time = caption.start
+        transcripts = self.transcripts
+        for position in range(len(transcripts)):
+            start_time = format_ms(transcripts.starts[position])
             if (
                 index + 1 < len(split_time)
                 and split_time[index + 1] == start_time.split(".")[0]
             ):
                 sections.append(TimeSpan(start=start_time))
+                texts.append([])
                 if last_end_time:
                     sections[index].set_end(last_end_time)
                 index += 1
 
-            sections[-1].add_transcript(caption.text)
-            last_end_time = caption.end
+            texts[-1].append(transcripts.text(position))
+            last_end_time = format_ms(transcripts.ends[position])
         sections[index].set_end(last_end_time)
+        for section, section_texts in zip(sections, texts):
+            section.content = "".join(section_texts)
 
         # for section in sections:
         #     print(section)
@@ -59,51 +81,103 @@ class VideoHandler:
 
         return sections
 
-    def read_transcripts(self):
-        """
-        Read all transcripts from vtt file
-        """
-        transcripts = []
-        for caption in self.vtt:
-            transcripts.append(TimeSpan(start=caption.start, end=caption.end))
-            transcripts[-1].add_transcript(caption.text)
-
-        return transcripts
-
-    def get_time_span(self, time, span_list):
+    def get_time_span(self, time_ms, span_list, index, max_gap=0):
         """
-        Get the transcript at a certain time from the list
+        Get the span at a certain time from the list
+        time_ms: time of the video in milliseconds
+        index: IntervalIndex of span_list
+        max_gap: in a gap between spans, take the previous span if it ended at most this long ago
         """
-        for span in span_list:
-            if span.within_span(time):
-                return span
+        position = index.find(time_ms, max_gap)
+        return span_list[position] if position is not None else None
 
-    async def request_keywords(self, current_time):
+    async def request_keywords(self, current_time, deadline=None):
         """
         Request keyword results from llm
         current_time: current time of the video, in seconds
+        deadline: Deadline of the request, passed on to the api call
         """
-        time_value = int(current_time)
-        format_time = f"{time_value // 3600:02d}:{(time_value % 3600) // 60:02d}:{time_value % 60:02d}"
-        try:
-            content = self.get_time_span(format_time, self.transcripts).content
-        except AttributeError:
-            print(f"Failed to find content at {format_time}")
+        time_ms = round(float(current_time) * 1000)
+        position = self.find_caption(time_ms)
+        if position is None:
+            print(f"Failed to find content at {format_ms(time_ms)}")
             return {"type": "video", "keywords": []}
-        keywords = await self.recommender.request_video_keywords(content)
+        if self.cached_keywords(position) is not None:
+            self.keyword_hits += 1
+        else:
+            self.keyword_misses += 1
+        keywords = await self.keywords_at(position, deadline=deadline)
         format_keywords = {
             "type": "video",
             "keywords": list(map(lambda x: x["keyword"], keywords)),
         }
         return format_keywords
 
+    def find_caption(self, time_ms):
+        """
+        return: position of the caption at the time, None if there is none
+        """
+        return self.transcripts.index.find(time_ms, MAX_GAP)
+
+    def cached_keywords(self, position):
+        return self.keywords.get(position)
+
+    async def keywords_at(self, position, deadline=None, priority=None):
+        """
+        Keywords of a caption, from the cache or the llm
+        position: position of the caption in the transcript
+        """
+        keywords = self.keywords.get(position)
+        if keywords is None:
+            keywords = await self.recommender.request_video_keywords(
+                self.transcripts.text(position), deadline=deadline, priority=priority
+            )
+            self.keywords[position] = keywords
+        return keywords
+
+    def memory_size(self):
+        """
+        return: estimated bytes held by the handler, the mapped transcript and the keywords
+        """
+        sections = sum(len(section.content) for section in self.section_recommend)
+        return len(self.transcripts.buffer) + sections + KEYWORD_BYTES * len(
+            self.keywords
+        )
+
+    def stats(self):
+        """
+        Keyword lookups of clients answered from the cache, most should be prefetched
+        """
+        lookups = self.keyword_hits + self.keyword_misses
+        return {
+            "keyword_hits": self.keyword_hits,
+            "keyword_misses": self.keyword_misses,
+            "hit_rate": self.keyword_hits / lookups if lookups else 0.0,
+            "prefetch": self.prefetcher.stats(),
+        }
+
+    def update_progress(self, client, data):
+        """
+        Playback report {"type": "progress", "value": seconds, "rate", "playing"} of a client
+        """
+        self.prefetcher.update(
+            client,
+            data["value"],
+            float(data.get("rate", 1.0)),
+            bool(data.get("playing", True)),
+        )
+
+    def remove_client(self, client):
+        self.prefetcher.remove(client)
+
     async def handle_time_change(self, current_time):
         """
         Judge if the current video progress should trigger auto recommendation
         """
-        time_value = int(current_time)
-        format_time = f"{time_value // 3600:02d}:{(time_value % 3600) // 60:02d}:{time_value % 60:02d}"
-        cur_section = self.get_time_span(format_time, self.section_recommend)
+        time_ms = round(float(current_time) * 1000)
+        cur_section = self.get_time_span(
+            time_ms, self.section_recommend, self.section_index
+        )
         if cur_section and cur_section != self.last_section:
             self.last_section = cur_section
             # return "test result"
@@ -115,10 +189,12 @@ class VideoHandler:
 class TimeSpan:
     def __init__(self, start, end=None):
         """
-        start: Time string in format %H:%M:%S
+        start: Time string in format %H:%M:%S or %H:%M:%S.%f
         """
         self.start = self.set_time(start)
+        self.start_ms = to_ms(start)
         self.end = None
+        self.end_ms = None
         self.set_end(end) if end else None
 
         self.content = ""
@@ -129,33 +205,123 @@ class TimeSpan:
         return datetime.strptime(string_time.split(".")[0], "%H:%M:%S").time()
 
     def set_end(self, string_end):
-        end_time = self.set_time(string_end)
-        assert self.start < end_time
-        self.end = end_time
+        end_ms = to_ms(string_end)
+        assert self.start_ms <= end_ms
+        self.end = self.set_time(string_end)
+        self.end_ms = end_ms
 
     def add_transcript(self, text):
-        pure_text = reduce(
-            lambda x, y: x.strip() + " " + y.strip(), text.split("&nbsp;")
-        )  # Clean &nbsp; in text
-        self.content += pure_text
+        self.content += clean_text(text)  # Clean &nbsp; in text
 
-    def within_span(self, time):
+    def within_span(self, time_ms):
         """
         Check if the time is within the span
+        time_ms: time in milliseconds
         """
-        return self.start <= self.set_time(time) <= self.end
+        return self.start_ms <= time_ms <= self.end_ms
 
     def __lt__(self, other):
         """
         Sort by start time
         """
-        return self.start < other.start
+        return self.start_ms < other.start_ms
 
     def __str__(self):
         return f"TimeSpan: {self.start} - {self.end} \nContent: {self.content}\n"
 
 
+def benchmark_index(sizes=(10000, 50000), lookups=2000):
+    """
+    Compare the linear scan with string times against the interval index,
+    on synthetic transcripts with overlapping captions
+    """
+    import random
+    import time as timer
+
+    generator = random.Random(0)
+    for size in sizes:
+        spans = []
+        start = 0
+        for i in range(size):
+            start += generator.randint(200, 1500)
+            end = start + generator.randint(500, 3000)  # overlaps the next captions
+            spans.append(TimeSpan(format_ms(start), format_ms(end)))
+        index = IntervalIndex.from_spans(spans)
+        times = [generator.randint(0, start) for _ in range(lookups)]
+
+        begin = timer.perf_counter()
+        for time_ms in times[:20]:
+            format_time = format_ms(time_ms).split(".")[0]
+            next(
+                (span for span in spans if span.start <= span.set_time(format_time) <= span.end),
+                None,
+            )
+        linear = (timer.perf_counter() - begin) / 20
+        begin = timer.perf_counter()
+        for time_ms in times:
+            index.find(time_ms, MAX_GAP)
+        indexed = (timer.perf_counter() - begin) / lookups
+        for time_ms in times[:200]:
+            expected = [i for i, span in enumerate(spans) if span.within_span(time_ms)]
+            assert sorted(index.find_all(time_ms)) == expected
+        print(
+            f"{size} captions: linear scan {linear * 1000:.2f} ms, "
+            f"index {indexed * 1e6:.2f} us per lookup"
+        )
+
+
+def benchmark_startup(size=20000):
+    """
+    Compare loading a long transcript by parsing the vtt into TimeSpan objects
+    against mapping its compiled cache
+    """
+    import os
+    import tempfile
+    import time as timer
+    import tracemalloc
+
+    import webvtt
+
+    path = os.path.join(tempfile.mkdtemp(), "long.en.vtt")
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("WEBVTT\n\n")
+        for i in range(size):
+            start = i * 1500
+            file.write(f"{format_ms(start)} --> {format_ms(start + 1400)}\n")
+            file.write(f"caption number {i} of the lecture&nbsp;with two lines\n\n")
+
+    def parse():
+        spans = []
+        for caption in webvtt.read(path):
+            spans.append(TimeSpan(start=caption.start, end=caption.end))
+            spans[-1].add_transcript(caption.text)
+        return spans
+
+    for name, load in [
+        ("parse vtt", parse),
+        ("compile", lambda: CompiledTranscript.load(path)),
+        ("load compiled", lambda: CompiledTranscript.load(path)),
+    ]:
+        tracemalloc.start()
+        begin = timer.perf_counter()
+        loaded = load()
+        elapsed = timer.perf_counter() - begin
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(
+            f"{name}: {elapsed * 1000:.1f} ms, {memory / 1024:.0f} KB kept "
+            f"for {len(loaded)} captions"
+        )
+
+
 if __name__ == "__main__":
+    import sys
+
+    if "--benchmark" in sys.argv:
+        benchmark_index()
+        benchmark_startup()
+        sys.exit()
+
     # TODO: ensure the time accuracy
     load_dotenv("key.env")
     recommender = ChatRecommender()
@@ -0,0 +1,81 @@
+import asyncio
+from websockets.exceptions import ConnectionClosed
+
+from protocol import Frame
+
+QUEUE_SIZE = 32  # max number of pending messages for one client
+MAX_DROPS = 64  # close the client after dropping this many messages in a row
+
+
+class ClientOutbox:
+    """
+    Bounded outbound queue of one client, drained by its own writer task.
+    A slow client only delays itself, other clients keep receiving.
+    """
+
+    def __init__(self, websocket, maxsize=QUEUE_SIZE, max_drops=MAX_DROPS):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize)
+        self.max_drops = max_drops
+        self.dropped = 0  # messages dropped since the last successful send
+        self.bytes_sent = 0
+        self.version = 1  # protocol version, negotiated at register
+        self.encoding = "json"
+        self.closed = False
+        self.writer = asyncio.create_task(self.drain())
+
+    def put(self, message):
+        """
+        Queue a message without waiting, the oldest message is dropped if full
+        message: Frame, or a serialized json string
+        return: False if the client can not keep up and is disconnected
+        """
+        if self.closed:
+            return False
+        if self.queue.full():
+            self.queue.get_nowait()  # drop the stale message
+            self.dropped += 1
+            if self.dropped >= self.max_drops:
+                print(f"Client too slow, disconnecting: {self.websocket.remote_address}")
+                self.close(disconnect=True)
+                return False
+        if isinstance(message, Frame):
+            message = message.encode(self.encoding)
+        self.queue.put_nowait(message)
+        return True
+
+    async def drain(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                await self.websocket.send(message)
+                self.bytes_sent += len(message)
+                self.dropped = 0
+        except ConnectionClosed:
+            print(f"Connection lost, device disconnected: {self.websocket.remote_address}")
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Error sending to {self.websocket.remote_address}: {e}")
+        finally:
+            self.closed = True
+
+    def close(self, disconnect=False):
+        """
+        Stop the writer task, pending messages are discarded
+        disconnect: also close the websocket, used for overflowing clients
+        """
+        self.closed = True
+        self.writer.cancel()
+        if disconnect:
+            asyncio.create_task(
+                self.websocket.close(code=1013, reason="Outbound queue overflow")
+            )
+
+
+def broadcast(outboxes, message):
+    """
+    Queue one message to all outboxes, a Frame is encoded once per encoding
+    return: the outboxes that are closed and should be removed
+    """
+    return [outbox for outbox in outboxes if not outbox.put(message)]
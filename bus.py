@@ -0,0 +1,106 @@
+import asyncio
+import json
+import os
+import struct
+
+BUS_PATH = "/tmp/socket_backend_bus.sock"  # unix socket shared by the workers
+HEADER = struct.Struct("!I")  # length prefix of each bus message
+
+
+class LocalBus:
+    """
+    In-process stand-in of the broadcast bus, buses created with the same hub
+    receive each other's messages. A single server uses its own hub, so publish is a no-op.
+    """
+
+    def __init__(self, hub=None):
+        self.hub = hub if hub is not None else []
+        self.on_message = None
+
+    async def start(self, on_message):
+        """
+        on_message: called with each message published by other workers
+        """
+        self.on_message = on_message
+        self.hub.append(self)
+
+    def publish(self, message):
+        for bus in self.hub:
+            if bus is not self and bus.on_message:
+                bus.on_message(message)
+
+    async def close(self):
+        if self in self.hub:
+            self.hub.remove(self)
+
+
+class UnixSocketBus:
+    """
+    Broadcast bus between worker processes, relayed by run_hub() over a unix socket
+    """
+
+    def __init__(self, path=BUS_PATH):
+        self.path = path
+        self.writer = None
+        self.reader_task = None
+
+    async def start(self, on_message):
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.reader_task = asyncio.create_task(self.read(reader, on_message))
+
+    async def read(self, reader, on_message):
+        try:
+            while True:
+                message = await read_frame(reader)
+                try:
+                    on_message(json.loads(message))
+                except Exception as e:
+                    print(f"Error handling bus message: {e}")
+        except asyncio.IncompleteReadError:
+            print("Bus connection closed")
+
+    def publish(self, message):
+        if self.writer is None:
+            return
+        data = json.dumps(message).encode("utf-8")
+        self.writer.write(HEADER.pack(len(data)) + data)
+
+    async def close(self):
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(HEADER.size)
+    return await reader.readexactly(HEADER.unpack(header)[0])
+
+
+async def run_hub(path=BUS_PATH):
+    """
+    Relay every message from one worker to all the other workers
+    """
+    workers = set()
+
+    async def relay(reader, writer):
+        workers.add(writer)
+        try:
+            while True:
+                message = await read_frame(reader)
+                frame = HEADER.pack(len(message)) + message
+                for other in workers:
+                    if other is not writer:
+                        other.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            workers.discard(writer)
+            writer.close()
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = await asyncio.start_unix_server(relay, path)
+    print(f"Broadcast bus running on {path}")
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,241 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import hashlib
+import json
+
+
+def hash_key(*parts):
+    """
+    Stable key from json serializable parts
+    """
+    data = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+TOUCH_BATCH = 100  # access times kept in memory before they are written
+
+
+class DiskCache:
+    """
+    SQLite backed cache with TTL and LRU eviction, can be shared by several processes.
+    Entries belong to a namespace and carry a tag, e.g. the prompt version they were made with.
+    Hits only read, their access times are written in batches. Async code uses aget / aput,
+    which run the sqlite calls in the default executor, off the event loop.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_entries=5000):
+        """
+        ttl: seconds an entry stays valid, None to keep it until evicted
+        max_entries: LRU eviction keeps at most this many entries
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.touched = {}  # key -> access time not written yet
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, namespace TEXT, tag TEXT, value TEXT, "
+            "created REAL, accessed REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS accessed ON entries (accessed)")
+        self.db.commit()
+
+    def get(self, key, ttl=None):
+        """
+        return: cached value, None if missing or expired
+        ttl: overrides the default ttl for this lookup
+        """
+        ttl = ttl if ttl is not None else self.ttl
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value, created FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (ttl is not None and now - row[1] > ttl):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched[key] = now
+            if len(self.touched) >= TOUCH_BATCH:
+                self.write_touched()
+                self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, key, value, namespace="", tag=""):
+        now = time.time()
+        with self.lock:
+            self.touched.pop(key, None)
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (key, namespace, tag, json.dumps(value), now, now),
+            )
+            self.write_touched()  # before eviction, which goes by access time
+            self.evict()
+            self.db.commit()
+
+    async def aget(self, key, ttl=None):
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key, ttl)
+
+    async def aput(self, key, value, namespace="", tag=""):
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.put, key, value, namespace, tag
+        )
+
+    async def astats(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self.stats)
+
+    def write_touched(self):
+        """
+        Write the access times of the hits since the last write, the caller commits
+        """
+        if self.touched:
+            self.db.executemany(
+                "UPDATE entries SET accessed = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self.touched.items()],
+            )
+            self.touched.clear()
+
+    def evict(self):
+        """
+        Remove the least recently used entries above max_entries
+        """
+        count = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute(
+                "DELETE FROM entries WHERE key IN "
+                "(SELECT key FROM entries ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def purge(self, namespace, keep_tag):
+        """
+        Remove the entries of a namespace made with another tag, e.g. an old prompt
+        return: number of removed entries
+        """
+        with self.lock:
+            removed = self.db.execute(
+                "DELETE FROM entries WHERE namespace = ? AND tag != ?",
+                (namespace, keep_tag),
+            ).rowcount
+            self.db.commit()
+        return removed
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+        }
+
+
+# Seconds a search result stays valid, prices change faster than organic results
+SEARCH_TTLS = {
+    "google_flights": 30 * 60,
+    "google_hotels": 6 * 3600,
+    "google_local": 3 * 24 * 3600,
+    "serper": 7 * 24 * 3600,
+}
+
+
+# Free text parameters, case and spacing do not change the search.
+# Others, e.g. departure_token, are opaque and kept as they are.
+TEXT_PARAMS = {"q", "location"}
+
+
+def normalize_params(params):
+    """
+    Search parameters without credentials and empty values, free text lowercased
+    and whitespace collapsed, so equal searches share a key
+    """
+    normalized = {}
+    for name, value in params.items():
+        if name == "api_key" or value is None:
+            continue
+        if name in TEXT_PARAMS and isinstance(value, str):
+            value = " ".join(value.lower().split())
+        normalized[name] = value
+    return normalized
+
+
+class SearchCache(DiskCache):
+    """
+    Cache of search api responses shared by SerperWrapper and SerpapiWrapper,
+    keyed by engine and normalized parameters, with a ttl per engine.
+    """
+
+    def __init__(self, path, ttls=None, max_entries=2000):
+        """
+        ttls: engine -> seconds, overrides SEARCH_TTLS
+        """
+        super().__init__(path, ttl=24 * 3600, max_entries=max_entries)
+        self.ttls = dict(SEARCH_TTLS, **(ttls or {}))
+        self.engine_stats = {}  # engine -> [hits, misses]
+
+    def get_result(self, engine, params):
+        """
+        return: cached response of the search, None if missing or expired
+        """
+        value = self.get(
+            hash_key(engine, normalize_params(params)), self.ttls.get(engine)
+        )
+        with self.lock:  # lookups run in executor threads
+            counts = self.engine_stats.setdefault(engine, [0, 0])
+            counts[0 if value is not None else 1] += 1
+        return value
+
+    def put_result(self, engine, params, value):
+        self.put(hash_key(engine, normalize_params(params)), value, engine)
+
+    async def aget_result(self, engine, params):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.get_result, engine, params
+        )
+
+    async def aput_result(self, engine, params, value):
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.put_result, engine, params, value
+        )
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            engine_stats = {engine: list(counts) for engine, counts in self.engine_stats.items()}
+        stats["engines"] = {
+            engine: {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            }
+            for engine, (hits, misses) in engine_stats.items()
+        }
+        return stats
+
+
+if __name__ == "__main__":
+    # Benchmark repeated search lookups, with a serper response as payload
+    import tempfile
+
+    with open("example_serper.json", "r", encoding="utf-8") as file:
+        response = {"organic": json.load(file)}
+    cache = SearchCache(os.path.join(tempfile.mkdtemp(), "search.sqlite"))
+    queries = [{"q": f"keyword {i}", "num": 10} for i in range(1000)]
+    for query in queries:
+        cache.put_result("serper", query, response)
+    start = time.perf_counter()
+    for query in queries:
+        assert cache.get_result("serper", dict(query, q=query["q"].upper())) is not None
+    lookup_time = (time.perf_counter() - start) / len(queries)
+    print(f"Repeat lookup {lookup_time * 1000:.3f} ms, stats: {cache.stats()}")
@@ -5,48 +5,357 @@ from dotenv import load_dotenv
 import json
 import asyncio
 import time
+import hashlib
+import copy
 
 from SerpapiWrapper import SerpapiWrapper
 from SerperWrapper import SerperWrapper
-from utility import extract_json_array
+from utility import extract_json_array, extract_json_object, JsonArrayStream
+from singleflight import SingleFlight, coalesce
+from cache import DiskCache, SearchCache, hash_key
+from similarity import SimilarityCache, near_duplicate
+from ratelimit import openai_scheduler, estimate_tokens, default_priority
+from deadline import timeout_of
+from routing import ModelRouter
+from hedge import hedger, hedged
+
+LLM_CACHE_PATH = "cache/llm.sqlite"
+SEARCH_CACHE_PATH = "cache/search.sqlite"
+
+# Fused mode: one call answers the prompts below, keyed by the result field
+PLAN_PARTS = {"widgets": "normal", "serp": "serp", "serper": "serper"}
+PLAN_PROMPT = """You solve the following {count} tasks for the same user input at once.
+Answer with a single json object and nothing else, in the form
+{{{fields}}}
+where each field holds the json array that its task asks for.
+{tasks}"""
 
 
 class ChatRecommender:
-    def __init__(self):
+    def __init__(
+        self,
+        prompt_vars=None,
+        cache_path=LLM_CACHE_PATH,
+        similarity_threshold=0.85,
+        fused=False,
+        search_cache_path=SEARCH_CACHE_PATH,
+        hedge=False,
+    ):
+        """
+        prompt_vars: placeholder -> value replaced in the prompts, e.g. {"<title>": title}
+        cache_path: sqlite file of the response cache, None to disable caching
+        similarity_threshold: reuse results of inputs at least this similar, None to disable
+        fused: widgets, serp and serper share one planner call instead of three calls
+        search_cache_path: sqlite file of the search result cache, None to disable caching
+        hedge: send a second copy of api calls and searches slower than their p95
+        """
         self.client = AsyncOpenAI()
-        self.prompts = {
-            "normal": self.read_prompt("normal"),
-            "serp": self.read_prompt("serp"),
-            "serper": self.read_prompt("serper"),
-            "video": self.read_prompt("video"),
-        }
-        self.serp_wrapper = SerpapiWrapper()
-        self.serper = SerperWrapper()
+        self.router = ModelRouter()  # model of each call, by prompt tier and latency
+        self.prompt_vars = prompt_vars or {}
+        self.prompts = {}  # name -> prompt template, placeholders are replaced per call
+        self.prompt_versions = {}  # name -> (file mtime, hash of the template)
+        for name in ["normal", "serp", "serper", "video"]:
+            self.load_prompt(name)
+        self.build_plan_prompt()
+        self.fused = fused
+        self.usage = {}  # prompt name -> [calls, prompt tokens, completion tokens]
+        self.scheduler = openai_scheduler  # rate limits shared with other callers
+        self.cache = DiskCache(cache_path) if cache_path else None
+        self.search_cache = (
+            SearchCache(search_cache_path) if search_cache_path else None
+        )
+        self.hedger = hedger if hedge else None
+        self.serp_wrapper = SerpapiWrapper(cache=self.search_cache, hedger=self.hedger)
+        self.serper = SerperWrapper(cache=self.search_cache, hedger=self.hedger)
+        self.inflight = SingleFlight()  # share identical concurrent requests
+        self.similar = (
+            SimilarityCache(similarity_threshold) if similarity_threshold else None
+        )  # reuse results of near-identical inputs, e.g. re-OCR of the same page
 
     def read_prompt(self, name):
         with open(f"prompts/{name}.txt", "r", encoding="utf-8") as file:
             return file.read()
 
-    async def create_chat(self, ai_name, text_input, format_tag="<plan>"):
+    def load_prompt(self, name):
+        prompt = self.read_prompt(name)
+        self.prompts[name] = prompt
+        self.prompt_versions[name] = (
+            os.path.getmtime(f"prompts/{name}.txt"),
+            hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+        )
+
+    def build_plan_prompt(self):
+        """
+        Combine the prompts of PLAN_PARTS into the prompt of the fused planner
+        """
+        fields = ", ".join(f'"{field}": [...]' for field in PLAN_PARTS)
+        tasks = "".join(
+            f"\n# Task for the field {field}\n{self.prompts[name]}\n"
+            for field, name in PLAN_PARTS.items()
+        )
+        prompt = PLAN_PROMPT.format(count=len(PLAN_PARTS), fields=fields, tasks=tasks)
+        self.prompts["plan"] = prompt
+        self.prompt_versions["plan"] = (
+            None,
+            hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+        )
+
+    def render_prompt(self, name):
+        """
+        return: the prompt with the placeholders of this recommender replaced
+        """
+        prompt = self.prompts[name]
+        for placeholder, value in self.prompt_vars.items():
+            prompt = prompt.replace(placeholder, value)
+        return prompt
+
+    def prompt_hash(self, name):
+        """
+        return: hash of the rendered prompt, e.g. to check precomputed results
+        """
+        return hashlib.sha256(self.render_prompt(name).encode("utf-8")).hexdigest()
+
+    def for_study(self, prompt_vars):
+        """
+        Recommender of one study, with its own placeholders, e.g. {"<title>": title}.
+        It shares the api client, prompts, caches and limits with this recommender,
+        only identical inputs of the same study are coalesced.
+        """
+        study = copy.copy(self)
+        study.prompt_vars = dict(self.prompt_vars, **prompt_vars)
+        study.inflight = SingleFlight()
+        study.similar = SimilarityCache(self.similar.threshold) if self.similar else None
+        return study
+
+    def refresh_prompt(self, name):
+        """
+        Reload the prompt if its file changed, cached responses of the old prompt are dropped
+        """
+        old_hash = self.prompt_versions[name][1]
+        if name == "plan":
+            for part in PLAN_PARTS.values():
+                self.refresh_prompt(part)
+            self.build_plan_prompt()
+        elif os.path.getmtime(f"prompts/{name}.txt") != self.prompt_versions[name][0]:
+            self.load_prompt(name)
+        new_hash = self.prompt_versions[name][1]
+        if self.cache and new_hash != old_hash:
+            removed = self.cache.purge(name, new_hash)
+            print(f"Prompt {name} changed, {removed} cached responses removed")
+
+    async def prepare_chat(self, ai_name, text_input, format_tag):
+        """
+        return: (cache key, messages, cached content or None)
+        """
         assert self.prompts.keys().__contains__(ai_name)
+        self.refresh_prompt(ai_name)
         format_input = self.format_text(text_input, format_tag)
-        completion = await self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "developer", "content": self.prompts[ai_name]},
-                {"role": "user", "content": format_input},
-            ],
+        prompt = self.render_prompt(ai_name)
+        key = hash_key(self.router.primary(ai_name), prompt, format_input)
+        messages = [
+            {"role": "developer", "content": prompt},
+            {"role": "user", "content": format_input},
+        ]
+        content = await self.cache.aget(key) if self.cache else None
+        if content is not None:
+            print(f"Cache hit for {ai_name}, hits: {self.cache.hits}")
+        return key, messages, content
+
+    async def save_chat(self, ai_name, key, content, model):
+        """
+        Cache the content under the key of the preferred model. Answers of a fallback
+        model are not cached, the fallback only covers a slow or failing model for now.
+        """
+        if self.cache and model == self.router.primary(ai_name):
+            await self.cache.aput(
+                key, content, ai_name, self.prompt_versions[ai_name][1]
+            )
+
+    async def create_chat(
+        self, ai_name, text_input, format_tag="<plan>", deadline=None, priority=None
+    ):
+        """
+        return: content of the completion, from the cache if the same input was seen
+        deadline: Deadline of the request, the api call times out with it
+        priority: key of ratelimit.PRIORITIES, by default from the prompt,
+        or the ratelimit.Ticket of coalesced requests
+        """
+        key, messages, content = await self.prepare_chat(
+            ai_name, text_input, format_tag
         )
-        print(
-            f"{completion.choices[0].message.role}:\n{completion.choices[0].message.content}"
+        if content is not None:
+            return content
+
+        tokens = await self.schedule(ai_name, messages, deadline, priority)
+        model = self.router.choose(ai_name)
+        start_time = time.perf_counter()
+        try:
+            completion = await hedged(
+                self.hedger,
+                f"chat/{ai_name}",
+                lambda: self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    **self.timeout_option(deadline),
+                ),
+                # The copy is a call of its own, skipped when the rate limits are reached
+                admit=lambda: self.scheduler.try_take(tokens),
+            )
+        except Exception:
+            self.router.record(ai_name, model, 0, success=False)
+            raise
+        self.router.record(ai_name, model, time.perf_counter() - start_time)
+        content = completion.choices[0].message.content
+        print(f"{completion.choices[0].message.role}:\n{content}")
+        self.record_usage(ai_name, completion.usage, tokens)
+        await self.save_chat(ai_name, key, content, model)
+        return content
+
+    async def schedule(self, ai_name, messages, deadline=None, priority=None):
+        """
+        Wait for the rate limits before an api call, video keywords go first
+        return: estimated tokens of the call
+        """
+        tokens = estimate_tokens(messages)
+        if priority is None:
+            priority = default_priority(ai_name)
+        await asyncio.wait_for(
+            self.scheduler.acquire(priority, tokens), timeout_of(deadline)
         )
-        return completion
+        return tokens
+
+    def timeout_option(self, deadline):
+        """
+        Per request timeout of the api call, the client default is kept without deadline
+        """
+        return {"timeout": deadline.timeout()} if deadline else {}
 
-    async def request_widgets(self, text_input):
+    def record_usage(self, ai_name, usage, estimated_tokens):
+        calls = self.usage.setdefault(ai_name, [0, 0, 0])
+        calls[0] += 1
+        if usage:
+            calls[1] += usage.prompt_tokens
+            calls[2] += usage.completion_tokens
+            actual_tokens = usage.prompt_tokens + usage.completion_tokens
+            self.scheduler.settle(estimated_tokens, actual_tokens)
+
+    async def request_array(self, ai_name, text_input, deadline=None):
+        """
+        Json array answered for a prompt, taken from the shared plan in fused mode
+        """
+        if self.fused and ai_name in PLAN_PARTS.values():
+            field = next(f for f, name in PLAN_PARTS.items() if name == ai_name)
+            plan = await self.request_plan(text_input, deadline=deadline)
+            return plan.get(field) or []
+        response = await self.create_chat(ai_name, text_input, deadline=deadline)
+        return json.loads(extract_json_array(response))
+
+    @coalesce("plan")
+    async def request_plan(self, text_input, deadline=None):
+        """
+        One planner call for widgets, serp and serper. The three requests of a
+        recommendation run concurrently, so they share this call through coalescing.
+        """
+        response = await self.create_chat("plan", text_input, deadline=deadline)
+        return json.loads(extract_json_object(response))
+
+    async def stream_chat(
+        self, ai_name, text_input, format_tag="<plan>", deadline=None
+    ):
+        """
+        Stream the completion and yield each object of its json array once it is complete
+        """
+        key, messages, content = await self.prepare_chat(
+            ai_name, text_input, format_tag
+        )
+        if content is not None:
+            for item in JsonArrayStream().feed(content):
+                yield item
+            return
+
+        tokens = await self.schedule(ai_name, messages, deadline)
+        model = self.router.choose(ai_name)
+        start_time = time.perf_counter()
+        parser = JsonArrayStream()
+        parts = []
+        usage = None
+        try:
+            # Hedged on the first token, the rest is read from the stream that won
+            stream, first_chunks = await hedged(
+                self.hedger,
+                f"stream/{ai_name}",
+                lambda: self.open_stream(model, messages, deadline),
+                admit=lambda: self.scheduler.try_take(tokens),
+            )
+
+            async def chunks():
+                for chunk in first_chunks:
+                    yield chunk
+                async for chunk in stream:
+                    yield chunk
+
+            async for chunk in chunks():
+                usage = chunk.usage or usage  # only in the last chunk
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                parts.append(chunk.choices[0].delta.content)
+                for item in parser.feed(parts[-1]):
+                    yield item
+        except Exception:
+            self.router.record(ai_name, model, 0, success=False)
+            raise
+        self.router.record(ai_name, model, time.perf_counter() - start_time)
+        content = "".join(parts)
+        print(f"assistant:\n{content}")
+        self.record_usage(ai_name, usage, tokens)
+        await self.save_chat(ai_name, key, content, model)
+
+    async def open_stream(self, model, messages, deadline=None):
+        """
+        Start a streamed completion and read it until its first content
+        return: (stream, chunks read so far), the stream goes on after these chunks
+        """
+        stream = await self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            **self.timeout_option(deadline),
+        )
+        chunks = []
+        try:
+            while True:
+                chunk = await stream.__anext__()
+                chunks.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    break
+        except StopAsyncIteration:
+            pass
+        except BaseException:
+            # Cancelled, e.g. the other copy of a hedged stream was first
+            await stream.close()
+            raise
+        return stream, chunks
+
+    @coalesce("normal")
+    @near_duplicate("normal")
+    async def request_widgets(self, text_input, on_item=None, deadline=None):
+        """
+        on_item: called with ("widgets", widget) for each widget as soon as it is generated,
+        enables streaming
+        deadline: Deadline of the request, passed on to the api calls
+        """
         start_time = time.perf_counter()
         print(f"Widgets API is starting in {start_time:.3f}")
-        response = await self.create_chat("normal", text_input)
-        widgets = json.loads(extract_json_array(response.choices[0].message.content))
+        if on_item and not self.fused:
+            widgets = []
+            async for widget in self.stream_chat(
+                "normal", text_input, deadline=deadline
+            ):
+                widgets.append(widget)
+                on_item("widgets", widget)
+        else:
+            widgets = await self.request_array("normal", text_input, deadline)
         try:
             assert widgets is not None and len(widgets) > 0
             end_time = time.perf_counter()
@@ -61,52 +370,71 @@ class ChatRecommender:
             print(f"Unknown Error for widgets: {e}")
             return self.format_result("widgets", "", [])
 
-    async def request_serp(self, text_input):
+    @coalesce("serp")
+    async def request_serp(self, text_input, deadline=None):
         """
         Request serp api based on the response from LLM.
+        All tool calls of the response run concurrently.
+        return: the result, or a list of results if several tools found something
         """
         start_time = time.perf_counter()
         print(f"Serp API is starting in {start_time:.3f}")
-        response = await self.create_chat("serp", text_input)
-        args = json.loads(extract_json_array(response.choices[0].message.content))
-        if args is None or len(args) == 0 or args[0]["tool"] == "":
+        args = await self.request_array("serp", text_input, deadline)
+        calls = [arg for arg in args or [] if arg.get("tool")]
+        if len(calls) == 0:
             print("There is no need to call serp api.")
             return self.format_result("defined", "", [])
 
+        results = await asyncio.gather(
+            *[self.call_serp(arg, deadline) for arg in calls]
+        )
+        results = [result for result in results if result is not None]
+        end_time = time.perf_counter()
+        print(
+            f"Serp API is finished in {end_time:.3f}, with spend time {end_time - start_time:.3f}"
+        )
+        if len(results) == 0:
+            return self.format_result("defined", "", [])
+        return results[0] if len(results) == 1 else results
+
+    async def call_serp(self, arg, deadline=None):
+        """
+        arg: one tool call from LLM, {"tool": api name, "keywords": comma separated args}
+        return: the result of the api, None if it failed
+        """
         try:
-            api_name = args[0]["tool"]
+            api_name = arg["tool"]
             assert api_name in ["SearchHotel", "SearchFlight", "SearchRestaurant"]
-            api_args = list(
-                map(lambda arg: arg.strip(), args[0]["keywords"].split(","))
-            )
+            api_args = list(map(lambda arg: arg.strip(), arg["keywords"].split(",")))
 
             print(f"API: {api_name}, Args: {api_args}")
             target_func = getattr(self.serp_wrapper, api_name)
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(None, target_func, *api_args)
-            end_time = time.perf_counter()
-            print(
-                f"Serp API is finished in {end_time:.3f}, with spend time {end_time - start_time:.3f}"
-            )
-            return result
+            return await target_func(*api_args, deadline=deadline)
         except AssertionError:
             print("API not found, check LLM response if it is correct.")
-            return self.format_result("defined", "", [])
         except Exception as e:
             print(
                 f"Error: Unknown exception for serp, type: {e.__class__.__name__} for {e}"
             )
-            return self.format_result("defined", "", [])
+        return None
 
-    async def request_serper(self, text_input):
+    @coalesce("serper")
+    @near_duplicate("serper")
+    async def request_serper(self, text_input, on_item=None, deadline=None):
+        """
+        on_item: called with ("serper", link) for each link as soon as it is found,
+        enables streaming, the searches start while the keywords are generated
+        """
         start_time = time.perf_counter()
         print(f"Serper API is starting in {start_time:.3f}")
         try:
-            response = await self.create_chat("serper", text_input)
-            args = json.loads(extract_json_array(response.choices[0].message.content))
-            list_args = list(map(lambda arg: arg["keyword"].strip(), args))
-            print(f"Serper Args: {list_args}")
-            links = await self.serper.post_all_questions(list_args)
+            if on_item and not self.fused:
+                links = await self.stream_serper(text_input, on_item, deadline)
+            else:
+                args = await self.request_array("serper", text_input, deadline)
+                list_args = list(map(lambda arg: arg["keyword"].strip(), args))
+                print(f"Serper Args: {list_args}")
+                links = await self.serper.post_all_questions(list_args, deadline)
             end_time = time.perf_counter()
             print(
                 f"Serper API is finished in {end_time:.3f}, with spend time {end_time - start_time:.3f}"
@@ -116,9 +444,40 @@ class ChatRecommender:
             print(f"Unknown Error for serper: {e}")
             return self.format_result("serper", "", [])
 
-    async def request_video_keywords(self, text_input):
-        response = await self.create_chat("video", text_input, "<transcript>")
-        keywords = json.loads(extract_json_array(response.choices[0].message.content))
+    async def stream_serper(self, text_input, on_item, deadline=None):
+        """
+        Search the keywords while they are generated, the keywords parsed during
+        a search are batched into the next request
+        """
+        keywords = asyncio.Queue()
+        searches = asyncio.ensure_future(
+            self.serper.search_queue(
+                keywords, lambda link: on_item("serper", link), deadline
+            )
+        )
+        try:
+            async for arg in self.stream_chat(
+                "serper", text_input, deadline=deadline
+            ):
+                keyword = arg["keyword"].strip()
+                print(f"Serper Arg: {keyword}")
+                keywords.put_nowait(keyword)
+            keywords.put_nowait(None)
+            return await searches
+        except BaseException:
+            searches.cancel()
+            raise
+
+    @coalesce("video", prioritized=True)
+    @near_duplicate("video")
+    async def request_video_keywords(self, text_input, deadline=None, priority=None):
+        """
+        priority: "background" for prefetching, below the requests of users
+        """
+        response = await self.create_chat(
+            "video", text_input, "<transcript>", deadline=deadline, priority=priority
+        )
+        keywords = json.loads(extract_json_array(response))
         print(f"Video Keywords:\n {keywords}")
         return keywords
 
@@ -159,5 +518,32 @@ if __name__ == "__main__":
             response = await recommender.request_serper(case)
             print(f"Response:\n{response}")
 
+    async def benchmark_fused():
+        """
+        Compare latency and tokens of the three calls against one fused planner call
+        """
+        separate = ChatRecommender(cache_path=None, similarity_threshold=None)
+        fused = ChatRecommender(cache_path=None, similarity_threshold=None, fused=True)
+        times = {"separate": [], "fused": []}
+        for case in test_case["content"]:
+            start = time.perf_counter()
+            await asyncio.gather(
+                *[separate.create_chat(name, case) for name in PLAN_PARTS.values()]
+            )
+            times["separate"].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            await fused.request_plan(case)
+            times["fused"].append(time.perf_counter() - start)
+        for mode, recommender in [("separate", separate), ("fused", fused)]:
+            calls, prompt_tokens, completion_tokens = map(
+                sum, zip(*recommender.usage.values())
+            )
+            print(
+                f"{mode}: mean {sum(times[mode]) / len(times[mode]):.3f}s, "
+                f"max {max(times[mode]):.3f}s, {calls} calls, "
+                f"{prompt_tokens} prompt tokens, {completion_tokens} completion tokens"
+            )
+
     asyncio.run(test_serper())
     # asyncio.run(test_normal())
+    # asyncio.run(benchmark_fused())
@@ -2,6 +2,12 @@ import shortUUID from "short-uuid";
 import { NoteData } from "./note-manager";
 
 const WEBSOCKET_URL = "ws://localhost:12345";
+const REQUEST_TIMEOUT = 15; // seconds, the server drops the work after it
+// Devices in the same session receive each other's results, e.g. ?session=desk1
+const SESSION =
+  new URLSearchParams(window.location.search).get("session") ?? "default";
+// Study served to this client, e.g. ?study=2, the server default if missing
+const STUDY = new URLSearchParams(window.location.search).get("study");
 
 export type Socket = {
   ws: WebSocket;
@@ -16,6 +22,7 @@ export type RecommendMessage = Message & {
   type: RecommendTypes;
   target: string;
   value: string;
+  parts?: number; // the result of this type is split into several messages
 };
 
 export type VideoMessage = Message & {
@@ -33,9 +40,28 @@ type EchoMessage = Message & {
   value: string;
 };
 
+// A single widget or link pushed before the full recommend result
+export type PartialMessage = Message & {
+  type: "partial";
+  target: "widgets" | "serper";
+  value: unknown;
+};
+
+type BusyMessage = Message & {
+  type: "busy";
+  value: string;
+};
+
+type ErrorMessage = Message & {
+  type: "error";
+  target: string; // type of the failed request
+  value: string;
+};
+
 type Message = {
   id: string;
   type: string;
+  timeout?: number;
 };
 
 const isValidRecommendType = (type: any): type is RecommendTypes => {
@@ -46,8 +72,11 @@ export let socket: Socket | undefined = undefined;
 
 let waitingRecommend: boolean = false; // true after recommend, reject all other sending recommend requests if waiting
 let responseResolve: Map<string, (value: ResponseMessage) => void> = new Map(); // id-resolve map for handling multiple requests
+let responseReject: Map<string, (reason: Error) => void> = new Map(); // id-reject map, used when server is busy
 let timeouts: Map<string, number> = new Map(); // id-timeout map
 let responseRecommends: Array<RecommendMessage> = []; // only used for the recommend request
+let recommendParts: Map<RecommendTypes, number> = new Map(); // type-number of messages, 1 if not set
+const partialListeners: Set<(message: PartialMessage) => void> = new Set();
 
 const initializeWebsocket = () => {
   if (socket === undefined) {
@@ -65,7 +94,17 @@ const initializeWebsocket = () => {
 
   socket.ws.onopen = () => {
     console.log(`Websocket connected to ${WEBSOCKET_URL}`);
-    // sendMessage(`{"type": "id", "id": "${socket!.id}"}`);
+    socket!.ws.send(
+      JSON.stringify({
+        id: shortUUID.generate(),
+        type: "register",
+        client: socket!.id,
+        session: SESSION,
+        study: STUDY ?? undefined,
+        protocol: 2, // id-only acks instead of echoing the whole message
+        encoding: "json", // frames are compressed by permessage-deflate
+      }),
+    );
   };
 
   socket.ws.onclose = () => {
@@ -75,13 +114,42 @@ const initializeWebsocket = () => {
   socket.ws.addEventListener("message", (event: MessageEvent) => {
     // console.log("Message from server ", event.data);
     const response: Message = JSON.parse(event.data);
-    if (response.type === "echo") {
+    if (response.type === "ack") {
+      console.log("Ack received: ", response.id);
+    } else if (response.type === "echo") {
       const echoResponse: EchoMessage = response as EchoMessage;
       console.log("Echo response received: ", echoResponse.id);
+    } else if (response.type === "partial") {
+      const partialResponse: PartialMessage = response as PartialMessage;
+      partialListeners.forEach((listener) => listener(partialResponse));
+    } else if (response.type === "registered") {
+      console.log(`Registered in session ${(response as EchoMessage).value}`);
+    } else if (response.type === "busy") {
+      const busyResponse: BusyMessage = response as BusyMessage;
+      console.warn(`Server busy, ${busyResponse.value} rejected`);
+      tryReject(busyResponse.id, new Error("Server busy: " + busyResponse.id));
+      if (busyResponse.value.startsWith("recommend")) {
+        resetRecStatus();
+      }
+    } else if (response.type === "error") {
+      const errorResponse: ErrorMessage = response as ErrorMessage;
+      console.error(
+        `Server error for ${errorResponse.target}: ${errorResponse.value}`,
+      );
+      tryReject(
+        errorResponse.id,
+        new Error("Server error: " + errorResponse.value),
+      );
+      if (errorResponse.target.startsWith("recommend")) {
+        resetRecStatus();
+      }
     } else if (isValidRecommendType(response.type)) {
       const recommendResponse: RecommendMessage = response as RecommendMessage;
       responseRecommends.push(recommendResponse);
-      if (responseRecommends.length === 3) {
+      if (recommendResponse.parts) {
+        recommendParts.set(recommendResponse.type, recommendResponse.parts);
+      }
+      if (responseRecommends.length === expectedRecommends()) {
         console.log("All recommend received");
         tryResolve(response.id, responseRecommends);
         resetRecStatus();
@@ -114,6 +182,7 @@ const tryResolve = (id: string, response: ResponseMessage) => {
   if (resolve) {
     resolve(response);
     responseResolve.delete(id);
+    responseReject.delete(id);
     clearTimeout(timeouts.get(id));
     timeouts.delete(id);
   } else {
@@ -121,9 +190,33 @@ const tryResolve = (id: string, response: ResponseMessage) => {
   }
 };
 
+/**
+ * Reject the pending request, e.g. when the server has no capacity for it
+ * @param id message id of the request
+ */
+const tryReject = (id: string, reason: Error) => {
+  const reject: ((reason: Error) => void) | undefined = responseReject.get(id);
+  if (reject) {
+    reject(reason);
+    responseResolve.delete(id);
+    responseReject.delete(id);
+    clearTimeout(timeouts.get(id));
+    timeouts.delete(id);
+  }
+};
+
 const resetRecStatus = () => {
   waitingRecommend = false;
   responseRecommends = [];
+  recommendParts.clear();
+};
+
+/**
+ * Number of messages for one recommend request, one per type unless split into parts
+ */
+const expectedRecommends = () => {
+  const types: RecommendTypes[] = ["widgets", "defined", "serper"];
+  return types.reduce((sum, type) => sum + (recommendParts.get(type) ?? 1), 0);
 };
 
 const sendMessage = (message: Message): Promise<ResponseMessage> => {
@@ -131,6 +224,7 @@ const sendMessage = (message: Message): Promise<ResponseMessage> => {
     (resolve, reject) => {
       if (socket && socket.ws.readyState === WebSocket.OPEN) {
         message.id = shortUUID.generate();
+        message.timeout = REQUEST_TIMEOUT;
         socket.ws.send(JSON.stringify(message));
         console.log(`Message ${message.id} sent, type: ${message.type}`);
         if (message.type.startsWith("recommend")) {
@@ -143,10 +237,12 @@ const sendMessage = (message: Message): Promise<ResponseMessage> => {
               resetRecStatus();
             }
             responseResolve.delete(message.id);
+            responseReject.delete(message.id);
             timeouts.delete(message.id);
-          }, 15 * 1000);
+          }, REQUEST_TIMEOUT * 1000);
           timeouts.set(message.id, timeOutId);
           responseResolve.set(message.id, resolve);
+          responseReject.set(message.id, reject);
         }
       } else {
         reject(new Error("Websocket is not connected or ready"));
@@ -170,6 +266,22 @@ const sendVideoProgress = (progress: number): Promise<VideoMessage> => {
   return sendMessage(message) as Promise<VideoMessage>;
 };
 
+/**
+ * Report the playback position, the server prefetches keywords of the next captions
+ * @param progress current time of the video in seconds
+ */
+const sendPlaybackProgress = (
+  progress: number,
+  rate: number,
+  playing: boolean,
+) => {
+  if (socket && socket.ws.readyState === WebSocket.OPEN) {
+    socket.ws.send(
+      JSON.stringify({ id: "", type: "progress", value: progress, rate, playing }),
+    );
+  }
+};
+
 const requestRecommend = (
   note: string,
   from: "pdf" | "video" | "note",
@@ -195,6 +307,17 @@ const requestSaveNote = (note: NoteData) => {
   sendMessage(message);
 };
 
+/**
+ * Listen to partial recommend results, which arrive before the full result
+ * @returns function to remove the listener
+ */
+const onPartialRecommend = (listener: (message: PartialMessage) => void) => {
+  partialListeners.add(listener);
+  return () => {
+    partialListeners.delete(listener);
+  };
+};
+
 const isWaiting = () => waitingRecommend;
 
 const closeWebsocket = () => {
@@ -203,6 +326,7 @@ const closeWebsocket = () => {
     (socket.ws.readyState === WebSocket.OPEN || WebSocket.CONNECTING)
   ) {
     responseResolve.clear();
+    responseReject.clear();
     timeouts.forEach((timeout) => {
       clearTimeout(timeout);
     });
@@ -217,7 +341,9 @@ export {
   initializeWebsocket,
   sendMessage,
   sendVideoProgress,
+  sendPlaybackProgress,
   requestSaveNote,
   requestRecommend,
+  onPartialRecommend,
   closeWebsocket,
 };
@@ -1,7 +1,11 @@
 import React, { useState, useRef } from "react";
 import { Editor } from "@tiptap/react";
 import VideoKeyBar from "./VideoKeyBar";
-import { sendVideoProgress, VideoMessage } from "./client-websocket";
+import {
+  sendPlaybackProgress,
+  sendVideoProgress,
+  VideoMessage,
+} from "./client-websocket";
 import useRecommender from "./useRecommender";
 
 type PlayerProps = {
@@ -23,6 +27,7 @@ const Player = (props: PlayerProps) => {
     undefined,
   );
   const videoRef = useRef<HTMLVideoElement>(null); // current video progress
+  const lastReport = useRef<number>(0); // time of the last progress report
 
   const [keywords, setKeywords] = useState<string[]>(["Hotel", "Food", "789"]);
 
@@ -80,6 +85,16 @@ const Player = (props: PlayerProps) => {
 
   const toggleSuggest = () => {
     setIsPaused(!isPaused);
+    reportProgress(true);
+  };
+
+  // Report the position every 2 seconds while playing, and at once on seek or pause
+  const reportProgress = (force: boolean) => {
+    const video = videoRef.current;
+    if (video && (force || Date.now() - lastReport.current >= 2000)) {
+      lastReport.current = Date.now();
+      sendPlaybackProgress(video.currentTime, video.playbackRate, !video.paused);
+    }
   };
 
   return (
@@ -114,7 +129,12 @@ const Player = (props: PlayerProps) => {
             src={props.videoPath}
             onPause={toggleSuggest}
             onPlay={toggleSuggest}
-            onTimeUpdate={() => setKeywords([])}
+            onTimeUpdate={() => {
+              setKeywords([]);
+              reportProgress(false);
+            }}
+            onSeeked={() => reportProgress(true)}
+            onRateChange={() => reportProgress(true)}
           >
             <track default src={props.subtitlePath} srcLang="en" />
           </video>
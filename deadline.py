@@ -0,0 +1,58 @@
+import asyncio
+import math
+import time
+
+REQUEST_TIMEOUT = 15  # seconds, the client gives up on a request after this
+MIN_TIMEOUT = 1  # seconds, range of the timeout a client may ask for
+MAX_TIMEOUT = 60
+
+
+class Deadline:
+    """
+    Point in time after which the result of a request is no longer wanted
+    """
+
+    def __init__(self, timeout=REQUEST_TIMEOUT):
+        self.expires = time.monotonic() + timeout
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def timeout(self):
+        """
+        Seconds left, to be used as timeout of a call
+        raise: asyncio.TimeoutError if the deadline has passed
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise asyncio.TimeoutError("Deadline exceeded")
+        return remaining
+
+    def extend(self, deadline):
+        """
+        Move the deadline to the later one, e.g. for a call shared by several requests
+        """
+        self.expires = max(self.expires, deadline.expires)
+
+
+def timeout_of(deadline, default=None):
+    """
+    Timeout for a call under an optional deadline
+    """
+    return deadline.timeout() if deadline else default
+
+
+def request_deadline(timeout=REQUEST_TIMEOUT):
+    """
+    Deadline of a client request, the timeout is clamped to MIN_TIMEOUT..MAX_TIMEOUT
+    timeout: seconds asked by the client
+    raise: ValueError if the timeout is not a number
+    """
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)):
+        raise ValueError(f"Invalid timeout {timeout!r}")
+    if not math.isfinite(timeout):
+        raise ValueError(f"Invalid timeout {timeout!r}")
+    return Deadline(min(max(timeout, MIN_TIMEOUT), MAX_TIMEOUT))
@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+from metrics import LatencyWindow
+
+
+class Hedger:
+    """
+    Hedged calls: if a call is still running at the p95 latency of its kind,
+    a second copy is sent and the first result wins, the other copy is cancelled.
+    Copies are limited to max_ratio of all calls, so hedging adds bounded load.
+    """
+
+    def __init__(self, max_ratio=0.05, min_samples=20, burst=5):
+        """
+        max_ratio: max extra calls per call, over all kinds
+        min_samples: calls of a kind before it is hedged
+        burst: max number of copies saved up while no call is slow
+        """
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.burst = burst
+        self.credit = 0.0  # copies that may be sent now
+        self.latency = {}  # kind -> LatencyWindow
+        self.counts = {}  # kind -> [calls, fired, won]
+
+    def delay(self, name):
+        """
+        return: seconds before a copy is sent, None if the kind has too few samples
+        """
+        window = self.latency.get(name)
+        if window is None or len(window) < self.min_samples:
+            return None
+        return window.percentile(0.95)
+
+    def record(self, name, seconds):
+        self.latency.setdefault(name, LatencyWindow()).add(seconds)
+
+    async def run(self, name, factory, admit=None):
+        """
+        name: kind of the call, e.g. "chat/normal", latencies are tracked per kind
+        factory: function returning a new coroutine of the call
+        admit: function returning False if the copy may not be sent now, e.g. rate limits
+        """
+        counts = self.counts.setdefault(name, [0, 0, 0])
+        counts[0] += 1
+        self.credit = min(self.burst, self.credit + self.max_ratio)
+        delay = self.delay(name)
+        start_time = time.perf_counter()
+        first = asyncio.ensure_future(factory())
+        tasks = [first]
+        try:
+            if delay is not None:
+                await asyncio.wait([first], timeout=delay)
+            if (
+                first.done()
+                or delay is None
+                or self.credit < 1
+                or (admit and not admit())
+            ):
+                result = await first
+                self.record(name, time.perf_counter() - start_time)
+                return result
+
+            self.credit -= 1
+            counts[1] += 1
+            print(f"Hedge {name} after {delay:.3f}s")
+            hedge_start = time.perf_counter()
+            tasks.append(asyncio.ensure_future(factory()))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is first:
+                            self.record(name, time.perf_counter() - start_time)
+                        else:
+                            counts[2] += 1
+                            self.record(name, time.perf_counter() - hedge_start)
+                        return task.result()
+            return first.result()  # both failed, raise the error of the original
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        calls = sum(counts[0] for counts in self.counts.values())
+        fired = sum(counts[1] for counts in self.counts.values())
+        return {
+            "extra_load": fired / calls if calls else 0.0,
+            "kinds": {
+                name: {
+                    "calls": counts[0],
+                    "fired": counts[1],
+                    "won": counts[2],
+                    "delay": self.delay(name),
+                }
+                for name, counts in self.counts.items()
+            },
+        }
+
+
+async def hedged(hedger, name, factory, admit=None):
+    """
+    Run the call through the hedger, or directly if hedging is disabled (hedger is None)
+    """
+    if hedger is None:
+        return await factory()
+    return await hedger.run(name, factory, admit)
+
+
+hedger = Hedger()  # shared by the hedged calls of the process, for the global cap
@@ -12,6 +12,7 @@ import utility
 from PDFViewer import ContinuousPDFViewer
 from PDFReader import Recommender
 from VideoHandler import VideoHandler
+from chat import ChatRecommender
 
 
 async def do_ocr_for_page_async(page_index, page):
@@ -94,12 +95,14 @@ if __name__ == "__main__":
         )
         root.mainloop()
     elif args.type == "v":
-        recommender = Recommender(search_assistant_id=os.getenv("VIDEO_ASSISTANT_ID"))
+        recommender = ChatRecommender()
         video_section = [
             "00:00:00",
             "00:00:57",
             "00:02:34",
         ]  # start time of each section
         handler = VideoHandler(recommender, "Short_Test_Video.en.vtt", video_section)
-        sockettest.video_callback = handler.request_keywords
+        sockettest.video_callback = (
+            lambda websocket, *args, **kwargs: handler.request_keywords(*args, **kwargs)
+        )
         asyncio.run(sockettest.start())
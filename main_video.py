@@ -4,15 +4,66 @@ from dotenv import load_dotenv
 import json
 import logging as log
 import datetime
+from functools import partial
 
 import sockettest
-from VideoHandler import VideoHandler
 from chat import ChatRecommender
+from studies import StudyServer, MEMORY_BUDGET
+
+
+def setup_callbacks(default_study=0, fused=False, hedge=False, memory_budget=MEMORY_BUDGET):
+    """
+    Serve all studies with one shared recommender and bind them to the server,
+    clients choose their study with ?study=n in the url or in the register message
+    """
+    load_dotenv("key.env")
+    with open("backend_study_setting.json", "r") as setting:
+        study_settings = json.load(setting)
+    recommender = ChatRecommender(fused=fused, hedge=hedge)
+    studies = StudyServer(study_settings, recommender, default_study, memory_budget)
+
+    sockettest.study_callback = studies.select
+    sockettest.rec_callback = studies.request_widgets
+    sockettest.serp_callback = studies.request_serp
+    sockettest.serper_callback = studies.request_serper
+    sockettest.video_callback = studies.request_keywords
+    sockettest.progress_callback = studies.update_progress
+    sockettest.leave_callback = studies.remove_client
+
+    async def stats_callback():
+        return {
+            "models": recommender.router.report(),
+            "studies": studies.stats(),
+            # The caches are shared by the studies, the sqlite count runs off the event loop
+            "llm_cache": await recommender.cache.astats() if recommender.cache else None,
+            "search_cache": await recommender.search_cache.astats()
+            if recommender.search_cache
+            else None,
+        }
+
+    sockettest.stats_callback = stats_callback
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--task", "-t", type=int, default=0)
+    parser.add_argument(
+        "--task", "-t", type=int, default=0, help="study of clients that choose none"
+    )
+    parser.add_argument(
+        "--workers", "-w", type=int, default=1, help="server processes, Linux only"
+    )
+    parser.add_argument(
+        "--fused", action="store_true", help="one planner call per recommendation"
+    )
+    parser.add_argument(
+        "--hedge", action="store_true", help="duplicate calls slower than their p95"
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=MEMORY_BUDGET // (1024 * 1024),
+        help="MB of loaded studies before unused ones are evicted",
+    )
     args = parser.parse_args()
 
     log.basicConfig(
@@ -23,21 +74,12 @@ if __name__ == "__main__":
     )
     log.info("Server started")
 
-    study_number = args.task
-    load_dotenv("key.env")
-    with open("backend_study_setting.json", "r") as setting:
-        study_setting = json.load(setting)[study_number]
-    print(f"The current city is {study_setting['city']}")
-    recommender = ChatRecommender()
-    recommender.prompts["video"] = recommender.prompts["video"].replace(
-        "<title>", study_setting["title"]
-    )
-    print(recommender.prompts["video"])
-    handler = VideoHandler(recommender, study_setting["transcript"])
-
-    sockettest.rec_callback = recommender.request_widgets
-    sockettest.serp_callback = recommender.request_serp
-    sockettest.serper_callback = recommender.request_serper
-    sockettest.video_callback = handler.request_keywords
-
-    asyncio.run(sockettest.start())
+    memory_budget = args.memory_budget * 1024 * 1024
+    if args.workers > 1:
+        sockettest.run_workers(
+            args.workers,
+            partial(setup_callbacks, args.task, args.fused, args.hedge, memory_budget),
+        )
+    else:
+        setup_callbacks(args.task, args.fused, args.hedge, memory_budget)
+        asyncio.run(sockettest.start())
@@ -0,0 +1,46 @@
+import threading
+from collections import deque
+
+
+class LatencyWindow:
+    """
+    Latencies of the most recent calls, for percentiles over a sliding window
+    """
+
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+        self.count = 0  # all samples ever added
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, q, default=None):
+        """
+        q: between 0 and 1, e.g. 0.95
+        return: latency at the percentile, default if there are no samples
+        """
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return default
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def mean(self, default=None):
+        with self.lock:
+            samples = list(self.samples)
+        return sum(samples) / len(samples) if samples else default
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean(0.0),
+            "p50": self.percentile(0.5, 0.0),
+            "p95": self.percentile(0.95, 0.0),
+            "max": self.percentile(1.0, 0.0),
+        }
@@ -0,0 +1,109 @@
+import asyncio
+import argparse
+import json
+import os
+import sys
+from dotenv import load_dotenv
+
+from chat import ChatRecommender
+from transcript import CompiledTranscript, load_keywords, save_keywords, keywords_path
+
+
+def journal_path(vtt_path):
+    return keywords_path(vtt_path) + "l"  # .keywords.jsonl
+
+
+def read_journal(vtt_path, digest, prompt_hash):
+    """
+    Keywords finished by an interrupted run with the same transcript and prompt
+    return: caption position -> keywords
+    """
+    keywords = {}
+    try:
+        with open(journal_path(vtt_path), "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # last line cut by the interruption
+                if entry["digest"] == digest.hex() and entry["prompt"] == prompt_hash:
+                    keywords[entry["position"]] = entry["keywords"]
+    except OSError:
+        pass
+    return keywords
+
+
+async def precompute(recommender, vtt_path, concurrency=4):
+    """
+    Request the keywords of every caption of the transcript and write the sidecar.
+    Each finished caption is appended to a journal, so a new run resumes after an interruption.
+    return: number of captions without keywords
+    """
+    transcripts = CompiledTranscript.load(vtt_path)
+    prompt_hash = recommender.prompt_hash("video")
+    keywords = load_keywords(vtt_path, transcripts.digest, prompt_hash)
+    keywords.update(read_journal(vtt_path, transcripts.digest, prompt_hash))
+    todo = [position for position in range(len(transcripts)) if position not in keywords]
+    print(f"{vtt_path}: {len(keywords)} captions done, {len(todo)} to request")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    with open(journal_path(vtt_path), "a", encoding="utf-8") as journal:
+
+        async def request(position):
+            async with semaphore:
+                try:
+                    result = await recommender.request_video_keywords(
+                        transcripts.text(position), priority="background"
+                    )
+                except Exception as e:
+                    print(f"Caption {position} failed, retried on the next run: {e}")
+                    return
+            keywords[position] = result
+            entry = {
+                "digest": transcripts.digest.hex(),
+                "prompt": prompt_hash,
+                "position": position,
+                "keywords": result,
+            }
+            journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            journal.flush()
+
+        await asyncio.gather(*[request(position) for position in todo])
+
+    save_keywords(vtt_path, transcripts.digest, prompt_hash, len(transcripts), keywords)
+    missing = len(transcripts) - len(keywords)
+    if missing == 0:
+        os.remove(journal_path(vtt_path))
+    print(f"Saved {keywords_path(vtt_path)}, {missing} captions missing")
+    return missing
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute the video keywords of the study transcripts"
+    )
+    parser.add_argument(
+        "--task", "-t", type=int, nargs="*", help="studies to compute, default all"
+    )
+    parser.add_argument(
+        "--concurrency", "-c", type=int, default=4, help="max concurrent llm calls"
+    )
+    args = parser.parse_args()
+
+    load_dotenv("key.env")
+    with open("backend_study_setting.json", "r") as setting:
+        study_settings = json.load(setting)
+    tasks = args.task if args.task else range(len(study_settings))
+
+    async def main():
+        recommender = ChatRecommender()
+        missing = 0
+        for study_number in tasks:
+            study_setting = study_settings[study_number]
+            study = recommender.for_study({"<title>": study_setting["title"]})
+            missing += await precompute(
+                study, study_setting["transcript"], args.concurrency
+            )
+        return missing
+
+    sys.exit(1 if asyncio.run(main()) else 0)
@@ -0,0 +1,102 @@
+import asyncio
+import time
+from bisect import bisect_right
+
+LOOKAHEAD = 3  # captions prefetched after the current one
+SEEK_THRESHOLD = 3000  # ms between the reported and the expected position to count as a seek
+
+
+class PlaybackState:
+    """
+    Last reported playback position of a client
+    """
+
+    def __init__(self, position_ms, rate, playing, reported_at):
+        self.position_ms = position_ms
+        self.rate = rate
+        self.playing = playing
+        self.reported_at = reported_at
+
+    def predict(self, now):
+        """
+        return: expected position at now, in ms
+        """
+        if not self.playing:
+            return self.position_ms
+        return self.position_ms + (now - self.reported_at) * 1000 * self.rate
+
+
+class KeywordPrefetcher:
+    """
+    Compute the keywords of the captions around each client's playback position
+    ahead of time, at background priority. A seek cancels the prefetch of the client.
+    """
+
+    def __init__(self, handler, lookahead=LOOKAHEAD, seek_threshold=SEEK_THRESHOLD):
+        """
+        handler: VideoHandler with the transcript and the keyword cache
+        """
+        self.handler = handler
+        self.lookahead = lookahead
+        self.seek_threshold = seek_threshold
+        self.clients = {}  # client -> PlaybackState
+        self.tasks = {}  # client -> running prefetch task
+        self.prefetched = 0
+        self.cancelled = 0
+
+    def update(self, client, time_s, rate=1.0, playing=True):
+        """
+        Record a reported position, restart the prefetch from it on a seek
+        client: hashable id of the client, e.g. its websocket
+        time_s: playback position in seconds
+        """
+        now = time.monotonic()
+        position_ms = round(float(time_s) * 1000)
+        state = self.clients.get(client)
+        seek = state is None or (
+            abs(state.predict(now) - position_ms) > self.seek_threshold
+        )
+        self.clients[client] = PlaybackState(position_ms, rate, playing, now)
+        task = self.tasks.get(client)
+        if task and not task.done():
+            if not seek:
+                return
+            task.cancel()
+            self.cancelled += 1
+        self.tasks[client] = asyncio.ensure_future(self.run(position_ms))
+
+    def remove(self, client):
+        self.clients.pop(client, None)
+        task = self.tasks.pop(client, None)
+        if task:
+            task.cancel()
+
+    def upcoming(self, position_ms):
+        """
+        return: positions of the caption at the time and the next ones
+        """
+        transcripts = self.handler.transcripts
+        first = self.handler.find_caption(position_ms)
+        if first is None:
+            first = bisect_right(transcripts.starts, position_ms)  # next after a gap
+        return range(first, min(len(transcripts), first + self.lookahead + 1))
+
+    async def run(self, position_ms):
+        for position in self.upcoming(position_ms):
+            if self.handler.cached_keywords(position) is not None:
+                continue
+            try:
+                await self.handler.keywords_at(position, priority="background")
+                self.prefetched += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Prefetch of caption {position} failed: {e}")
+                return
+
+    def stats(self):
+        return {
+            "clients": len(self.clients),
+            "prefetched": self.prefetched,
+            "cancelled": self.cancelled,
+        }
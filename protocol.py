@@ -0,0 +1,85 @@
+import json
+
+try:
+    import orjson  # faster encoder, optional
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack  # binary encoding, optional
+except ImportError:
+    msgpack = None
+
+# Protocol 1: full echo of every request, json text frames
+# Protocol 2: id-only acks, json or msgpack frames
+PROTOCOL_VERSIONS = (1, 2)
+ENCODINGS = ("json", "msgpack") if msgpack else ("json",)
+
+
+def dumps(data):
+    """
+    Serialize to a json string, using orjson if available
+    """
+    if orjson:
+        return orjson.dumps(data).decode("utf-8")
+    return json.dumps(data)
+
+
+def loads(message):
+    """
+    Parse an incoming message, binary frames are msgpack and text frames are json
+    """
+    if isinstance(message, (bytes, bytearray)):
+        if msgpack is None:
+            raise ValueError("Binary message received but msgpack is not installed")
+        return msgpack.unpackb(message, raw=False)
+    return orjson.loads(message) if orjson else json.loads(message)
+
+
+def negotiate(data):
+    """
+    Pick the protocol version and encoding from a register message
+    return: (version, encoding) supported by both sides
+    """
+    version = data.get("protocol", 1)
+    version = version if version in PROTOCOL_VERSIONS else 1
+    encoding = data.get("encoding", "json")
+    encoding = encoding if version >= 2 and encoding in ENCODINGS else "json"
+    return version, encoding
+
+
+def ack(message_id, version, raw=None):
+    """
+    Acknowledge a request, protocol 1 echoes the whole message back
+    """
+    if version >= 2:
+        return Frame({"id": message_id, "type": "ack"})
+    return Frame({"id": message_id, "type": "echo", "value": raw})
+
+
+class Frame:
+    """
+    A message encoded at most once per encoding, shared by all recipients
+    """
+
+    def __init__(self, data):
+        """
+        data: dict, or a json string that is already serialized, or plain text
+        """
+        self.data = data if isinstance(data, dict) else None
+        self.encoded = {"json": data} if isinstance(data, str) else {}
+
+    def encode(self, encoding="json"):
+        if encoding not in self.encoded:
+            if self.data is None:
+                try:
+                    self.data = json.loads(self.encoded["json"])
+                except ValueError:
+                    # Plain text, e.g. a notice of send_message_once, sent as it is
+                    self.encoded[encoding] = self.encoded["json"]
+                    return self.encoded[encoding]
+            if encoding == "msgpack":
+                self.encoded[encoding] = msgpack.packb(self.data)
+            else:
+                self.encoded[encoding] = dumps(self.data)
+        return self.encoded[encoding]
@@ -0,0 +1,278 @@
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from metrics import LatencyWindow
+
+# Lower runs first, video keywords are waited for by a playing video
+PRIORITIES = {"video": 0, "recommend": 1, "background": 2}
+COMPLETION_TOKENS = 600  # expected completion size when estimating a call
+
+
+def estimate_tokens(messages, completion_tokens=COMPLETION_TOKENS):
+    """
+    Rough token count of a call, about 4 characters per token
+    messages: chat messages or a plain text input
+    """
+    if isinstance(messages, str):
+        text_length = len(messages)
+    else:
+        text_length = sum(len(str(message.get("content", ""))) for message in messages)
+    return text_length // 4 + completion_tokens
+
+
+class TokenBucket:
+    """
+    Bucket refilled at rate_per_minute, holds at most one minute of budget
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.level = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """
+        return: seconds until amount is available, 0 if it is available now
+        """
+        self.refill(now)
+        amount = min(amount, self.capacity)  # a huge call still runs with a full bucket
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount):
+        self.level -= amount
+
+    def resize(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.level = min(self.level, rate_per_minute)
+        self.rate = rate_per_minute / 60
+
+
+class Waiter:
+    def __init__(self, priority, tokens, seq, loop=None):
+        self.priority = priority
+        self.tokens = tokens
+        self.seq = seq
+        self.loop = loop  # None for a waiting thread
+        self.event = asyncio.Event() if loop else threading.Event()
+        self.enqueued = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def wake(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.event.set)
+        else:
+            self.event.set()
+
+
+class Ticket:
+    """
+    Priority of one call that several requests may share, see RateScheduler.promote
+    """
+
+    def __init__(self, priority):
+        self.priority = priority  # key of PRIORITIES
+        self.waiter = None  # while the call waits in the scheduler
+
+
+def default_priority(ai_name):
+    """
+    return: priority of a prompt's calls, video keywords go first
+    """
+    return "video" if ai_name == "video" else "recommend"
+
+
+class RateScheduler:
+    """
+    Gate in front of every OpenAI call, keeps requests and tokens per minute under
+    the account limits. Calls wait in priority order, then in arrival order.
+    Both coroutines and threads can wait, e.g. the synchronous assistant calls.
+    """
+
+    def __init__(self, rpm=500, tpm=30000):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.queue = []  # heap of Waiter
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.waits = {name: LatencyWindow() for name in PRIORITIES}
+        self.granted = 0
+
+    def share(self, parts):
+        """
+        Keep this process to its part of the limits, e.g. one of several server workers
+        parts: number of processes sharing the account limits
+        """
+        with self.lock:
+            self.requests.resize(self.requests.capacity / parts)
+            self.tokens.resize(self.tokens.capacity / parts)
+
+    def try_acquire(self, waiter):
+        """
+        Called under the lock
+        return: 0 if granted, seconds to wait, None to wait until woken as the head
+        """
+        if self.queue[0] is not waiter:
+            return None
+        now = time.monotonic()
+        wait = max(
+            self.requests.wait_time(1, now),
+            self.tokens.wait_time(waiter.tokens, now),
+        )
+        if wait > 0:
+            return wait
+        self.requests.take(1)
+        self.tokens.take(waiter.tokens)
+        heapq.heappop(self.queue)
+        self.granted += 1
+        if self.queue:
+            self.queue[0].wake()
+        return 0
+
+    def try_take(self, tokens=COMPLETION_TOKENS):
+        """
+        Take the budget of a call without waiting, e.g. for a hedged copy
+        return: False if calls are waiting or the budget is used up
+        """
+        now = time.monotonic()
+        with self.lock:
+            if (
+                self.queue
+                or self.requests.wait_time(1, now) > 0
+                or self.tokens.wait_time(tokens, now) > 0
+            ):
+                return False
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.granted += 1
+            return True
+
+    def enqueue(self, ticket, tokens, loop=None):
+        with self.lock:
+            waiter = Waiter(
+                PRIORITIES[ticket.priority], tokens, next(self.counter), loop
+            )
+            ticket.waiter = waiter
+            heapq.heappush(self.queue, waiter)
+        return waiter
+
+    def promote(self, ticket, priority):
+        """
+        Raise the priority of a call, also while it waits,
+        e.g. when a user request joins a background prefetch
+        """
+        with self.lock:
+            if PRIORITIES[priority] >= PRIORITIES[ticket.priority]:
+                return
+            ticket.priority = priority
+            waiter = ticket.waiter
+            if waiter is not None and waiter in self.queue:
+                waiter.priority = PRIORITIES[priority]
+                heapq.heapify(self.queue)
+                self.queue[0].wake()
+
+    def dequeue(self, waiter):
+        """
+        Remove a waiter that gave up, e.g. cancelled at its deadline
+        """
+        with self.lock:
+            if waiter in self.queue:
+                head = self.queue[0] is waiter
+                self.queue.remove(waiter)
+                heapq.heapify(self.queue)
+                if head and self.queue:
+                    self.queue[0].wake()
+
+    def record_wait(self, priority, waiter):
+        self.waits[priority].add(time.monotonic() - waiter.enqueued)
+
+    async def acquire(self, priority="recommend", tokens=COMPLETION_TOKENS):
+        """
+        Wait until the call may run
+        priority: key of PRIORITIES, or a Ticket to raise the priority while waiting
+        tokens: estimated tokens of the call, see estimate_tokens
+        """
+        ticket = priority if isinstance(priority, Ticket) else Ticket(priority)
+        waiter = self.enqueue(ticket, tokens, asyncio.get_running_loop())
+        try:
+            while True:
+                waiter.event.clear()  # before the check, so no wake is lost
+                with self.lock:
+                    wait = self.try_acquire(waiter)
+                if wait == 0:
+                    break
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self.dequeue(waiter)
+            raise
+        finally:
+            ticket.waiter = None
+        self.record_wait(ticket.priority, waiter)
+
+    def acquire_sync(self, priority="recommend", tokens=COMPLETION_TOKENS):
+        """
+        Blocking acquire for calls made from threads
+        """
+        ticket = priority if isinstance(priority, Ticket) else Ticket(priority)
+        waiter = self.enqueue(ticket, tokens)
+        try:
+            while True:
+                waiter.event.clear()
+                with self.lock:
+                    wait = self.try_acquire(waiter)
+                if wait == 0:
+                    break
+                waiter.event.wait(wait)
+        except BaseException:
+            self.dequeue(waiter)
+            raise
+        finally:
+            ticket.waiter = None
+        self.record_wait(ticket.priority, waiter)
+
+    def settle(self, estimated, actual):
+        """
+        Correct the token budget with the actual usage of a finished call
+        """
+        if actual is None:
+            return
+        with self.lock:
+            self.tokens.level = min(
+                self.tokens.capacity, self.tokens.level + estimated - actual
+            )
+
+    def stats(self):
+        with self.lock:
+            depth = {name: 0 for name in PRIORITIES}
+            names = {value: name for name, value in PRIORITIES.items()}
+            for waiter in self.queue:
+                depth[names[waiter.priority]] += 1
+            budget = {
+                "requests": round(self.requests.level, 1),
+                "tokens": round(self.tokens.level),
+            }
+        return {
+            "granted": self.granted,
+            "queue": depth,
+            "budget": budget,
+            "wait": {name: window.to_dict() for name, window in self.waits.items()},
+        }
+
+
+# Shared by all OpenAI callers of the process, limits of the account tier
+openai_scheduler = RateScheduler(
+    rpm=int(os.getenv("OPENAI_RPM", 500)), tpm=int(os.getenv("OPENAI_TPM", 30000))
+)
@@ -0,0 +1,116 @@
+import time
+from collections import OrderedDict
+
+from websockets.protocol import State
+
+IDLE_TIMEOUT = 60  # seconds without any message before a connection is checked
+
+
+class ConnectionInfo:
+    """
+    Metadata of one connection
+    """
+
+    def __init__(self, websocket, outbox):
+        self.websocket = websocket
+        self.outbox = outbox
+        self.connected_at = time.monotonic()
+        self.last_active = self.connected_at  # last received message
+        self.last_seen = self.connected_at  # last message or check by sweep()
+        self.rtt = None  # seconds, from the keepalive pings
+        self.bytes_in = 0
+        self.messages_in = 0
+
+    def to_dict(self, now):
+        self.rtt = getattr(self.websocket, "latency", self.rtt)
+        return {
+            "address": str(self.websocket.remote_address),
+            "connected": round(now - self.connected_at, 1),
+            "idle": round(now - self.last_active, 1),
+            "rtt": self.rtt,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.outbox.bytes_sent,
+            "messages_in": self.messages_in,
+            "queue": self.outbox.queue.qsize(),
+            "dropped": self.outbox.dropped,
+        }
+
+
+class ConnectionRegistry:
+    """
+    All connected devices, ordered from the least to the most recently seen.
+    Activity moves an entry to the end, so idle entries are found at the front in O(1).
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT):
+        self.entries = OrderedDict()  # websocket -> ConnectionInfo
+        self.idle_timeout = idle_timeout
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, websocket):
+        return websocket in self.entries
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __getitem__(self, websocket):
+        return self.entries[websocket]
+
+    def add(self, websocket, outbox):
+        info = ConnectionInfo(websocket, outbox)
+        self.entries[websocket] = info
+        return info
+
+    def remove(self, websocket):
+        return self.entries.pop(websocket, None)
+
+    def touch(self, websocket, size=0):
+        """
+        Record a received message of size bytes
+        """
+        info = self.entries.get(websocket)
+        if info is None:
+            return
+        info.last_active = info.last_seen = time.monotonic()
+        info.bytes_in += size
+        info.messages_in += 1
+        self.entries.move_to_end(websocket)
+
+    def take_idle(self):
+        """
+        Collect the entries not seen for idle_timeout and move them to the end,
+        so each of them is checked once per idle period
+        return: list of ConnectionInfo, only idle entries are visited
+        """
+        now = time.monotonic()
+        idle = []
+        while self.entries:
+            websocket, info = next(iter(self.entries.items()))
+            if info.last_seen > now - self.idle_timeout:
+                break
+            info.last_seen = now
+            self.entries.move_to_end(websocket)
+            idle.append(info)
+        return idle
+
+    def sweep(self):
+        """
+        Find idle connections that are closed but not removed yet. The keepalive
+        of websockets.serve pings every connection and closes the unresponsive ones,
+        so only the state is checked here, without pings of its own.
+        return: list of ConnectionInfo, the caller removes them
+        """
+        return [
+            info
+            for info in self.take_idle()
+            if info.websocket.state is not State.OPEN or info.outbox.closed
+        ]
+
+    def snapshot(self):
+        """
+        Diagnostics of all connections, for the stats request
+        """
+        now = time.monotonic()
+        return [info.to_dict(now) for info in self.entries.values()]
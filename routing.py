@@ -0,0 +1,118 @@
+import threading
+from collections import deque
+
+from metrics import LatencyWindow
+
+# Models of each tier, preferred first and fastest last
+MODEL_TIERS = {
+    "quality": ["gpt-4o"],
+    "balanced": ["gpt-4o", "gpt-4o-mini"],
+    "fast": ["gpt-4o-mini"],
+}
+# Prompt name -> (tier, p95 latency SLO in seconds, None to never fall back),
+# the SLO of a one model tier is only reported
+ROUTES = {
+    "normal": ("quality", None),  # widget quality is not traded for latency
+    "plan": ("quality", None),  # the fused plan includes the widgets
+    "serper": ("balanced", 4.0),
+    "serp": ("fast", 2.5),  # only picks a tool and its arguments
+    "video": ("fast", 2.0),  # a few keywords from one caption
+}
+DEFAULT_ROUTE = ("quality", None)
+
+
+class ModelStats:
+    """
+    Observed latency and failures of one model on one route
+    """
+
+    def __init__(self, size=50):
+        self.latency = LatencyWindow(size)
+        self.results = deque(maxlen=size)  # True for success
+
+    def failure_rate(self):
+        if not self.results:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+
+class ModelRouter:
+    """
+    Choose the model of each call from the tier of its prompt. A model whose
+    p95 latency breaks the SLO or that fails too often is skipped for the next
+    model of the tier, and still gets a probe call now and then to recover.
+    """
+
+    def __init__(
+        self, routes=None, min_samples=5, max_failure_rate=0.2, probe_every=10
+    ):
+        """
+        routes: prompt name -> (tier, SLO), overrides ROUTES
+        min_samples: calls before a model is judged
+        probe_every: every n-th call of a degraded route goes to the preferred model
+        """
+        self.routes = dict(ROUTES, **(routes or {}))
+        self.min_samples = min_samples
+        self.max_failure_rate = max_failure_rate
+        self.probe_every = probe_every
+        self.stats = {}  # (prompt name, model) -> ModelStats
+        self.calls = {}  # prompt name -> number of routed calls
+        self.fallbacks = {}  # prompt name -> number of calls sent to a fallback model
+        self.lock = threading.Lock()
+
+    def models(self, ai_name):
+        tier, _ = self.routes.get(ai_name, DEFAULT_ROUTE)
+        return MODEL_TIERS[tier]
+
+    def primary(self, ai_name):
+        """
+        return: preferred model of the route, e.g. for cache keys
+        """
+        return self.models(ai_name)[0]
+
+    def healthy(self, ai_name, model):
+        _, slo = self.routes.get(ai_name, DEFAULT_ROUTE)
+        stats = self.stats.get((ai_name, model))
+        if stats is None or len(stats.results) < self.min_samples:
+            return True
+        if stats.failure_rate() > self.max_failure_rate:
+            return False
+        return slo is None or stats.latency.percentile(0.95, 0.0) <= slo
+
+    def choose(self, ai_name):
+        """
+        return: model for the next call of the route
+        """
+        models = self.models(ai_name)
+        with self.lock:
+            calls = self.calls[ai_name] = self.calls.get(ai_name, 0) + 1
+            for model in models[:-1]:
+                if self.healthy(ai_name, model) or calls % self.probe_every == 0:
+                    return model
+            if len(models) > 1:
+                self.fallbacks[ai_name] = self.fallbacks.get(ai_name, 0) + 1
+            return models[-1]
+
+    def record(self, ai_name, model, seconds, success=True):
+        _, slo = self.routes.get(ai_name, DEFAULT_ROUTE)
+        with self.lock:
+            recovered = success and slo is not None and seconds <= slo
+            if recovered and not self.healthy(ai_name, model):
+                # A probe met the SLO, judge the model on new calls only
+                del self.stats[(ai_name, model)]
+            stats = self.stats.setdefault((ai_name, model), ModelStats())
+            stats.results.append(success)
+            if success:
+                stats.latency.add(seconds)
+
+    def report(self):
+        with self.lock:
+            models = {
+                f"{ai_name}/{model}": dict(
+                    stats.latency.to_dict(),
+                    failure_rate=stats.failure_rate(),
+                    healthy=self.healthy(ai_name, model),
+                )
+                for (ai_name, model), stats in self.stats.items()
+            }
+            return {"models": models, "fallbacks": dict(self.fallbacks)}
@@ -0,0 +1,45 @@
+DEFAULT_SESSION = "default"  # unregistered devices share this session
+
+
+class SessionRouter:
+    """
+    Group websockets into sessions, so results only reach the requester's devices
+    """
+
+    def __init__(self):
+        self.sessions = {}  # session name -> set of websockets
+        self.session_of = {}  # websocket -> session name
+        self.client_ids = {}  # websocket -> client id sent in the handshake
+
+    def join(self, websocket, session=DEFAULT_SESSION, client_id=None):
+        """
+        Add a websocket to a session, leaving its previous one
+        """
+        self.leave(websocket)
+        self.sessions.setdefault(session, set()).add(websocket)
+        self.session_of[websocket] = session
+        if client_id:
+            self.client_ids[websocket] = client_id
+
+    def leave(self, websocket):
+        session = self.session_of.pop(websocket, None)
+        self.client_ids.pop(websocket, None)
+        if session is None:
+            return
+        members = self.sessions[session]
+        members.discard(websocket)
+        if not members:
+            del self.sessions[session]
+
+    def members(self, session):
+        """
+        return: websockets in the session, empty if the session does not exist
+        """
+        return self.sessions.get(session, set())
+
+    def peers(self, websocket):
+        """
+        return: all websockets in the same session as the given one, itself included
+        """
+        session = self.session_of.get(websocket)
+        return self.members(session) if session is not None else {websocket}
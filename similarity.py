@@ -0,0 +1,162 @@
+import functools
+import re
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+# Below 2**32, so a * x + b of values reduced mod the prime fits in uint64
+MERSENNE_PRIME = np.uint64((1 << 31) - 1)
+
+
+class SimilarityCache:
+    """
+    Near-duplicate cache, inputs are matched by MinHash over word shingles
+    and candidates are found with LSH buckets instead of scanning all entries.
+    """
+
+    def __init__(
+        self, threshold=0.85, num_perm=64, bands=16, shingle=3, max_entries=20000
+    ):
+        """
+        threshold: min estimated jaccard similarity to reuse a result
+        num_perm: length of the signature, split into bands of num_perm // bands rows
+        shingle: number of words in each shingle
+        """
+        assert num_perm % bands == 0
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle = shingle
+        self.max_entries = max_entries
+        generator = np.random.RandomState(1)
+        self.a = generator.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = generator.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.entries = OrderedDict()  # id -> (signature, bucket keys, value)
+        self.buckets = {}  # (name, band, band hash) -> set of ids
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    def shingles(self, text):
+        words = re.findall(r"\w+", text.lower())
+        if len(words) < self.shingle:
+            words = words + [""] * (self.shingle - len(words))
+        return {
+            " ".join(words[i : i + self.shingle])
+            for i in range(len(words) - self.shingle + 1)
+        }
+
+    def signature(self, text):
+        hashes = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) for s in self.shingles(text)),
+            dtype=np.uint64,
+        ) % MERSENNE_PRIME
+        # One row of (a * x + b) mod p per permutation, the min over shingles
+        permuted = (np.outer(self.a, hashes) + self.b[:, None]) % MERSENNE_PRIME
+        return permuted.min(axis=1)
+
+    def bucket_keys(self, name, signature):
+        return [
+            (name, band, signature[band * self.rows : (band + 1) * self.rows].tobytes())
+            for band in range(self.bands)
+        ]
+
+    def lookup(self, name, text):
+        """
+        return: (value, similarity) of the most similar earlier input, (None, 0) if none reaches threshold
+        """
+        signature = self.signature(text)
+        candidates = set()
+        for key in self.bucket_keys(name, signature):
+            candidates |= self.buckets.get(key, set())
+        best, best_similarity = None, 0.0
+        for entry_id in candidates:
+            similarity = float(np.mean(self.entries[entry_id][0] == signature))
+            if similarity > best_similarity:
+                best, best_similarity = entry_id, similarity
+        if best is None or best_similarity < self.threshold:
+            self.misses += 1
+            return None, best_similarity
+        self.hits += 1
+        self.entries.move_to_end(best)
+        return self.entries[best][2], best_similarity
+
+    def add(self, name, text, value):
+        signature = self.signature(text)
+        keys = self.bucket_keys(name, signature)
+        entry_id = self.next_id
+        self.next_id += 1
+        self.entries[entry_id] = (signature, keys, value)
+        for key in keys:
+            self.buckets.setdefault(key, set()).add(entry_id)
+        while len(self.entries) > self.max_entries:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, entry_id):
+        _, keys, _ = self.entries.pop(entry_id)
+        for key in keys:
+            bucket = self.buckets[key]
+            bucket.discard(entry_id)
+            if not bucket:
+                del self.buckets[key]
+
+
+def near_duplicate(name):
+    """
+    Decorator for ChatRecommender requests, reuse the result of a near-identical earlier input.
+    The instance needs a `similar` SimilarityCache attribute, None to disable.
+    name: prompt name, inputs of different prompts or prompt versions never match
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, text_input, *args, **kwargs):
+            if self.similar is None:
+                return await func(self, text_input, *args, **kwargs)
+            self.refresh_prompt(name)  # results of an edited prompt are not reused
+            key = (name, self.prompt_versions[name][1])
+            result, similarity = self.similar.lookup(key, text_input)
+            if result is not None:
+                print(f"Near-duplicate input for {name}, similarity {similarity:.2f}")
+                return result
+            result = await func(self, text_input, *args, **kwargs)
+            # Do not remember failures, they are returned with an empty value
+            if result.get("value") if isinstance(result, dict) else result:
+                self.similar.add(key, text_input, result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+if __name__ == "__main__":
+    # Benchmark lookup cost against cache size
+    generator = np.random.RandomState(0)
+    vocabulary = [f"word{i}" for i in range(5000)]
+
+    def random_text(length=120):
+        return " ".join(generator.choice(vocabulary, size=length))
+
+    cache = SimilarityCache(max_entries=50000)
+    queries = [random_text() for _ in range(200)]
+    size = 0
+    for target in [1000, 10000, 50000]:
+        while size < target:
+            cache.add("normal", random_text() if size >= 200 else queries[size], size)
+            size += 1
+        start = time.perf_counter()
+        for query in queries:
+            cache.signature(query)
+        signature_time = (time.perf_counter() - start) / len(queries)
+        # Near duplicates of early entries: a few words changed
+        edited = [q.replace("word1 ", "word2 ", 2) + " extra" for q in queries]
+        start = time.perf_counter()
+        found = sum(cache.lookup("normal", q)[0] is not None for q in edited)
+        lookup_time = (time.perf_counter() - start) / len(edited)
+        print(
+            f"{target:>6} entries: lookup {lookup_time * 1000:.3f} ms "
+            f"(signature {signature_time * 1000:.3f} ms), {found}/{len(edited)} found"
+        )
@@ -0,0 +1,145 @@
+import asyncio
+import functools
+
+from deadline import Deadline, timeout_of
+from ratelimit import Ticket, default_priority
+
+
+class SingleFlight:
+    """
+    Run one call per key at a time, concurrent callers with the same key share its result.
+    The result object is shared, callers should not modify it.
+    """
+
+    def __init__(self):
+        self.calls = {}  # key -> [future, number of waiters, state]
+        self.shared = 0  # number of calls that joined an in-flight one
+
+    async def do(self, key, factory, state=None, enter=None, timeout=None):
+        """
+        key: hashable key of the call
+        factory: function returning the coroutine to run if no call is in flight
+        state: kept with a started call, e.g. the SharedCall of coalesce
+        enter: called with the state of the call, started or joined
+        timeout: seconds this caller waits, the call goes on for the other callers
+        """
+        call = self.calls.get(key)
+        if call is None:
+            future = asyncio.ensure_future(factory())
+            call = [future, 0, state]
+            self.calls[key] = call
+            future.add_done_callback(lambda _: self.forget(key, future))
+        else:
+            self.shared += 1
+            print(f"Join in-flight request {key[0]}, shared {self.shared} times")
+        if enter:
+            enter(call[2])
+        call[1] += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(call[0]), timeout)
+        except BaseException:
+            # Cancelled or timed out, only cancel the call when nobody else is waiting for it
+            if call[1] == 1:
+                call[0].cancel()
+            raise
+        finally:
+            call[1] -= 1
+
+    def forget(self, key, future):
+        call = self.calls.get(key)
+        if call and call[0] is future:
+            del self.calls[key]
+
+
+class SharedCall:
+    """
+    What the callers of one coalesced call share: the streamed items, which are
+    passed to the on_item of every caller, the deadline and the priority ticket
+    """
+
+    def __init__(self, deadline=None, ticket=None, streaming=False):
+        self.deadline = deadline  # latest deadline of the callers
+        self.ticket = ticket
+        self.streaming = streaming  # the call was started with an on_item
+        self.items = []  # arguments of each on_item call so far
+        self.listeners = []
+
+    def listen(self, on_item):
+        for item in self.items:  # a late caller gets the items it missed
+            on_item(*item)
+        self.listeners.append(on_item)
+
+    def forget(self, on_item):
+        if on_item in self.listeners:
+            self.listeners.remove(on_item)
+
+    def emit(self, *item):
+        self.items.append(item)
+        for on_item in list(self.listeners):
+            on_item(*item)
+
+
+def normalize_text(text):
+    """
+    Collapse whitespace, so inputs that only differ in spacing share a key
+    """
+    return " ".join(str(text).split())
+
+
+def coalesce(name, prioritized=False):
+    """
+    Decorator for ChatRecommender requests, identical concurrent inputs share one call.
+    The instance needs an `inflight` SingleFlight attribute.
+    Each caller waits until its own deadline, and gets the streamed items through
+    its own on_item, both are passed by keyword. A call started without on_item
+    does not stream, a caller joining it with an on_item only gets the result.
+    name: prompt name, part of the key
+    prioritized: the request takes a priority, a joining request raises the priority
+    of the shared call to its own, so a user request does not wait as a prefetch
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, text_input, *args, **kwargs):
+            key = (name, normalize_text(text_input))
+            deadline = kwargs.get("deadline")
+            on_item = kwargs.get("on_item")
+            shared = SharedCall(
+                Deadline(deadline.remaining()) if deadline else None,
+                Ticket(kwargs.get("priority") or default_priority(name))
+                if prioritized
+                else None,
+                streaming=bool(on_item),
+            )
+            if "deadline" in kwargs:
+                kwargs["deadline"] = shared.deadline
+            if on_item:
+                kwargs["on_item"] = shared.emit
+            if prioritized:
+                kwargs["priority"] = shared.ticket
+            entered = []
+
+            def enter(call):
+                entered.append(call)
+                if deadline and call.deadline:
+                    call.deadline.extend(deadline)
+                if on_item and call.streaming:
+                    call.listen(on_item)
+                if prioritized:
+                    self.scheduler.promote(call.ticket, shared.ticket.priority)
+
+            try:
+                return await self.inflight.do(
+                    key,
+                    lambda: func(self, text_input, *args, **kwargs),
+                    state=shared,
+                    enter=enter,
+                    timeout=timeout_of(deadline),
+                )
+            finally:
+                if on_item and entered:
+                    entered[0].forget(on_item)
+
+        return wrapper
+
+    return decorator
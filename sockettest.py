@@ -1,21 +1,39 @@
 import asyncio
+import multiprocessing
+import os
+import time
 import websockets
 import webbrowser
 import re
-import json
 import uuid
 import logging as log
+from urllib.parse import urlparse, parse_qs
 
 from dotenv import load_dotenv
 from asyncio import create_task
 from utility import save_note
+from broadcast import ClientOutbox, broadcast
+from session import SessionRouter, DEFAULT_SESSION
+from protocol import Frame, ack, dumps, loads, negotiate
+from registry import ConnectionRegistry
+from bus import LocalBus, UnixSocketBus, BUS_PATH, run_hub
+from deadline import REQUEST_TIMEOUT, request_deadline
+from ratelimit import openai_scheduler
+from hedge import hedger
 
-connected_devices = set()
+connected_devices = ConnectionRegistry()  # websocket -> ConnectionInfo
+sessions = SessionRouter()  # results are routed to the requester's session
+bus = LocalBus()  # relays messages to other workers, see run_workers()
 # ws_loop = None  # 全局变量，用于保存后台线程的事件循环
+# Request callbacks take the requesting websocket first, to serve its study
 video_callback = None  # handle time change
 rec_callback = None  # call normal recommender
 serp_callback = None  # call serp api
 serper_callback = None  # call serper api
+progress_callback = None  # playback position of a client, for prefetching
+leave_callback = None  # client disconnected
+study_callback = None  # client chose a study, returns its study, the load is not waited for
+stats_callback = None  # async, returns more fields of the stats reply, e.g. model routing
 # action_callback = None  # handle action
 
 # Record the number of requests for each type
@@ -26,94 +44,342 @@ request_type = {
     "open": 0,
 }
 
+STREAM_PARTIALS = True  # push each widget / link as soon as it is ready to protocol 2 clients
+MAX_IN_FLIGHT = 8  # max number of concurrent requests for one connection
+# max number of concurrent requests of each kind for one connection
+KIND_LIMITS = {
+    "open": 4,
+    "video": 2,
+    "recommend": 1,
+    "save": 2,
+}
+
 
 async def handler(websocket):
-    connected_devices.add(websocket)
+    outbox = ClientOutbox(websocket)
+    connected_devices.add(websocket, outbox)
+    sessions.join(websocket)  # until the device registers its own session
+    study = query_param(websocket, "study")
+    if study_callback and study is not None:
+        # Clients without a choice are served the default study on their first request
+        study_callback(websocket, study)
     print(
         f"Device connected from {websocket.remote_address}, Total: {len(connected_devices)}"
     )
+    in_flight = set()  # running request tasks of this connection
+    kind_counts = {}  # number of running requests for each kind
+
+    def release(task, kind):
+        in_flight.discard(task)
+        kind_counts[kind] -= 1
+
     try:
         websocket.ping_interval = 20  # Seconds between pings
         websocket.ping_timeout = 15  # Seconds to wait for pong response
         async for message in websocket:
-            print(f"Received: {message}")
-            data = json.loads(message)
-            message_id = data["id"] if "id" in data else "no_id"
-            if "id" in data:
-                await websocket.send(
-                    json.dumps({"id": message_id, "type": "echo", "value": message})
-                )
-            else:
-                await websocket.send(json.dumps({"echo": message}))
-
-            # TODO: set the proper format for links
-            if data["type"] == "open":
-                # webbrowser.open_new_tab(data["value"]) if data["value"] else None
-                data["id"] = str(uuid.uuid1())
-                create_task(send_message_once(json.dumps(data)))
-                request_type["open"] += 1
-                log.info(f"Open link request: {data['value']}")
-                log_request_count()
-            elif data["type"] == "video":
-                result = await video_callback(data["value"])
-                result["id"] = message_id
-                create_task(send_message_once(json.dumps(result)))
-            elif data["type"].startswith("recommend"):
-                call_from = data["type"].split("-")[1]
-                request_type[call_from] += 1
-                tasks = [
-                    rec_callback(data["value"]),
-                    serp_callback(data["value"]),
-                    serper_callback(data["value"]),
-                ]
-                for future in asyncio.as_completed(tasks):
-                    result = await future
-                    result["id"] = message_id
-                    create_task(send_message_once(json.dumps(result)))
-                log.info(f"Recommendation request from {call_from.upper()}")
-                log_request_count()
-            elif data["type"] == "save":
-                save_note(data["value"])
-                log.info("END: Save note request")
+            message_id = "no_id"
+            try:
+                print(f"Received: {message}")
+                connected_devices.touch(websocket, len(message))
+                data = loads(message)
+                message_id = data["id"] if "id" in data else "no_id"
+                if data["type"] == "register":
+                    register(websocket, data)
+                    continue
+                if data["type"] == "progress":
+                    # Frequent and fire-and-forget, no ack
+                    if progress_callback:
+                        progress_callback(websocket, data)
+                    continue
+                if data["type"] == "stats":
+                    stats = {
+                        "id": message_id,
+                        "type": "stats",
+                        "value": connected_devices.snapshot(),
+                        "openai": openai_scheduler.stats(),
+                        "hedge": hedger.stats(),
+                    }
+                    if stats_callback:
+                        stats.update(await stats_callback())
+                    outbox.put(Frame(stats))
+                    continue
+                raw = message if isinstance(message, str) else None
+                if "id" in data:
+                    outbox.put(ack(message_id, outbox.version, raw))
+                else:
+                    outbox.put(dumps({"echo": raw}))
 
+                kind = request_kind(data["type"])
+                if len(in_flight) >= MAX_IN_FLIGHT or kind_counts.get(
+                    kind, 0
+                ) >= KIND_LIMITS.get(kind, MAX_IN_FLIGHT):
+                    # Reject instead of queueing, so the client can retry later
+                    busy = {"id": message_id, "type": "busy", "value": data["type"]}
+                    outbox.put(Frame(busy))
+                    log.info(f"Busy: rejected {data['type']} request {message_id}")
+                    continue
+
+                kind_counts[kind] = kind_counts.get(kind, 0) + 1
+                task = create_task(dispatch(websocket, data, message_id))
+                in_flight.add(task)
+                task.add_done_callback(lambda t, kind=kind: release(t, kind))
+            except Exception as e:
+                # A bad message fails alone, the connection stays open
+                print(f"Error while handling message {message_id}: {e!r}")
+                outbox.put(error_frame(message_id, e))
     except websockets.exceptions.ConnectionClosed:
         print(f"Device disconnected: {websocket.remote_address}")
     finally:
-        connected_devices.remove(websocket)
+        # Nobody is waiting for the results anymore
+        for task in list(in_flight):
+            task.cancel()
+        remove_device(websocket)
         print(f"Remaining Devices: {len(connected_devices)}")
 
 
-async def send_message_once(message, type=None, target=""):
+def error_frame(message_id, error, target=""):
+    """
+    Reply to a request that failed on the server, the client stops waiting for it
+    target: type of the failed request
+    """
+    return Frame(
+        {"id": message_id, "type": "error", "target": target, "value": str(error)}
+    )
+
+
+def request_kind(message_type):
+    """
+    Group message types for concurrency limits, e.g. recommend-pdf -> recommend
+    """
+    return message_type.split("-")[0]
+
+
+def query_param(websocket, name):
+    """
+    Parameter of the connection url, e.g. ws://host:12345/?study=2
+    return: the value, None if not given
+    """
+    request = getattr(websocket, "request", None)
+    values = parse_qs(urlparse(request.path if request else "").query).get(name)
+    return values[0] if values else None
+
+
+def register(websocket, data):
+    """
+    Handshake {"type": "register", "id", "client", "session", "protocol", "encoding", "study"}:
+    move the device into a session, negotiate the protocol version and select the study
+    """
+    session = data.get("session") or DEFAULT_SESSION
+    sessions.join(websocket, session, data.get("client"))
+    outbox = connected_devices[websocket].outbox
+    version, encoding = negotiate(data)
+    reply = {
+        "id": data.get("id", "no_id"),
+        "type": "registered",
+        "value": session,
+        "protocol": version,
+        "encoding": encoding,
+    }
+    if study_callback and data.get("study") is not None:
+        reply["study"] = study_callback(websocket, data["study"])
+    # The reply is always json, the negotiated encoding applies to later messages
+    outbox.put(dumps(reply))
+    outbox.version, outbox.encoding = version, encoding
+    print(
+        f"Device {websocket.remote_address} registered in session {session}, protocol {version}/{encoding}"
+    )
+
+
+async def dispatch(websocket, data, message_id):
+    """
+    Handle one request message, runs as its own task.
+    Work is cancelled once the client stops waiting, at the request timeout.
+    """
+    # Results go to the requester's session unless the request opts in broadcasting
+    async def reply(message, min_version=1):
+        if data.get("broadcast"):
+            await send_message_once(message, min_version=min_version)
+        else:
+            await send_to_session(websocket, message, min_version)
+
+    try:
+        # An invalid timeout fails the request with an error frame
+        deadline = request_deadline(data.get("timeout", REQUEST_TIMEOUT))
+        # TODO: set the proper format for links
+        if data["type"] == "open":
+            # webbrowser.open_new_tab(data["value"]) if data["value"] else None
+            data["id"] = str(uuid.uuid1())
+            create_task(reply(Frame(data)))
+            request_type["open"] += 1
+            log.info(f"Open link request: {data['value']}")
+            log_request_count()
+        elif data["type"] == "video":
+            result = await asyncio.wait_for(
+                video_callback(websocket, data["value"], deadline=deadline),
+                deadline.timeout(),
+            )
+            create_task(reply(Frame(dict(result, id=message_id))))
+        elif data["type"].startswith("recommend"):
+            call_from = data["type"].split("-")[1]
+            request_type[call_from] += 1
+
+            def push_partial(kind, item):
+                if deadline.expired():
+                    return
+                partial = {"id": message_id, "type": "partial", "target": kind}
+                # Only protocol 2 peers understand partial results
+                create_task(reply(Frame(dict(partial, value=item)), min_version=2))
+
+            async def guarded(kind, source):
+                """
+                A failed source answers with an empty result, the others still arrive
+                """
+                try:
+                    return await source
+                except Exception as e:
+                    print(f"{kind} of request {message_id} failed: {e!r}")
+                    return {"type": kind, "target": "", "value": []}
+
+            on_item = push_partial if streams_partials(websocket) else None
+            tasks = [
+                asyncio.ensure_future(guarded(kind, source))
+                for kind, source in [
+                    (
+                        "widgets",
+                        rec_callback(
+                            websocket, data["value"], on_item=on_item, deadline=deadline
+                        ),
+                    ),
+                    (
+                        "defined",
+                        serp_callback(websocket, data["value"], deadline=deadline),
+                    ),
+                    (
+                        "serper",
+                        serper_callback(
+                            websocket, data["value"], on_item=on_item, deadline=deadline
+                        ),
+                    ),
+                ]
+            ]
+            try:
+                for future in asyncio.as_completed(tasks, timeout=deadline.remaining()):
+                    result = await future  # may be shared with other requests, copy it
+                    if isinstance(result, list):
+                        # Several serp tools, the client waits for all parts
+                        for part in result:
+                            message = dict(part, id=message_id, parts=len(result))
+                            create_task(reply(Frame(message)))
+                    else:
+                        create_task(reply(Frame(dict(result, id=message_id))))
+            finally:
+                for task in tasks:
+                    task.cancel()
+            log.info(f"Recommendation request from {call_from.upper()}")
+            log_request_count()
+        elif data["type"] == "save":
+            save_note(data["value"])
+            log.info("END: Save note request")
+    except asyncio.TimeoutError:
+        log.info(f"Deadline exceeded, dropped {data['type']} request {message_id}")
+    except Exception as e:
+        print(f"Error while handling {data['type']} request {message_id}: {e}")
+        if websocket in connected_devices:
+            outbox = connected_devices[websocket].outbox
+            outbox.put(error_frame(message_id, e, data["type"]))
+
+
+def streams_partials(websocket):
+    """
+    Only protocol 2 clients understand partial results
+    """
+    return (
+        STREAM_PARTIALS
+        and websocket in connected_devices
+        and connected_devices[websocket].outbox.version >= 2
+    )
+
+
+async def send_message_once(message, type=None, target="", min_version=1):
     """
     Broadcast a message to all connected devices
+    message: Frame, or serialized json string if type is not given
     type: type of message
     target: target for defined objects
+    min_version: devices with an older protocol version are skipped
     """
     print("send_message_once() called")  # 新增调试打印
     format_message = (
-        json.dumps({"type": type, "target": target, "value": message})
+        Frame({"type": type, "target": target, "value": message})
         if type
         else message
     )
 
     if connected_devices:
-        disconnected = set()
-        for ws in connected_devices.copy():
-            try:
-                await ws.send(format_message)
-                print(f"Successfully sent to {ws.remote_address}: {format_message}")
-            except websockets.exceptions.ConnectionClosed:
-                print(f"Connection lost, device disconnected: {ws.remote_address}")
-                disconnected.add(ws)
-            except Exception as e:
-                print(f"Error sending to {ws.remote_address}: {e}")
-                disconnected.add(ws)
-
-        for ws in disconnected:
-            if ws in connected_devices:
-                connected_devices.remove(ws)
+        deliver(list(connected_devices), format_message, min_version)
     else:
         print("No connected devices.")
+    publish(None, format_message, min_version)
+
+
+async def send_to_session(websocket, message, min_version=1):
+    """
+    Send a message to all devices in the session of the websocket,
+    including those connected to other workers
+    min_version: devices with an older protocol version are skipped
+    """
+    deliver(sessions.peers(websocket), message, min_version)
+    session = sessions.session_of.get(websocket)
+    if session is not None:
+        publish(session, message, min_version)
+
+
+def publish(session, message, min_version=1):
+    """
+    Forward a message to the other workers
+    session: session name, None for all devices
+    """
+    if isinstance(message, Frame):
+        message = message.encode("json")
+    bus.publish({"session": session, "message": message, "min_version": min_version})
+
+
+def on_bus_message(data):
+    """
+    Deliver a message published by another worker to the local devices
+    """
+    session = data["session"]
+    targets = connected_devices if session is None else sessions.members(session)
+    deliver(list(targets), Frame(data["message"]), data.get("min_version", 1))
+
+
+def deliver(targets, message, min_version=1):
+    """
+    Queue a message to the given devices, it is encoded once per encoding
+    and each client's writer task sends it concurrently
+    min_version: devices with an older protocol version are skipped
+    """
+    outboxes = [
+        connected_devices[ws].outbox
+        for ws in targets
+        if ws in connected_devices
+        and connected_devices[ws].outbox.version >= min_version
+    ]
+    for outbox in broadcast(outboxes, message):
+        remove_device(outbox.websocket)
+    print(f"Message queued for {len(outboxes)} devices")
+
+
+def remove_device(websocket):
+    """
+    Forget a device and stop its writer task
+    """
+    sessions.leave(websocket)
+    info = connected_devices.remove(websocket)
+    if info:
+        info.outbox.close()
+    if leave_callback:
+        leave_callback(websocket)
 
 
 async def periodic_sender():
@@ -123,39 +389,32 @@ async def periodic_sender():
 
 
 async def heartbeat():
+    """
+    Sweep the registry every 10 seconds for connections closed by the keepalive
+    of websockets.serve, or whose writer stopped, that were not removed yet
+    """
     while True:
-        if connected_devices:
-            disconnected = set()
-            for ws in connected_devices.copy():
-                try:
-                    # Send a ping message
-                    pong_waiter = await ws.ping()
-                    await asyncio.wait_for(
-                        pong_waiter, timeout=5
-                    )  # Wait for a pong within 5 seconds
-                    print(f"Ping successful to {ws.remote_address}")
-                except asyncio.TimeoutError:
-                    print(f"No pong received, device disconnected: {ws.remote_address}")
-                    disconnected.add(ws)
-                except websockets.exceptions.ConnectionClosed:
-                    print(
-                        f"Connection closed, device disconnected: {ws.remote_address}"
-                    )
-                    disconnected.add(ws)
-                except Exception as e:
-                    print(f"Error during heartbeat with {ws.remote_address}: {e}")
-                    disconnected.add(ws)
-
-            # Remove disconnected devices
-            for ws in disconnected:
-                if ws in connected_devices:
-                    connected_devices.remove(ws)
+        try:
+            for info in connected_devices.sweep():
+                print(f"Connection closed, device removed: {info.websocket.remote_address}")
+                remove_device(info.websocket)
+                create_task(info.websocket.close())
+        except Exception as e:
+            print(f"Error during heartbeat: {e}")
 
-        await asyncio.sleep(10)  # Send heartbeat every 10 seconds
+        await asyncio.sleep(10)
 
 
-async def start():
+async def start(reuse_port=False, bus_path=None):
+    """
+    reuse_port: let several workers listen on the same port (SO_REUSEPORT)
+    bus_path: unix socket of the bus hub, None for a single server
+    """
+    global bus
     load_dotenv("key.env")
+    if bus_path:
+        bus = UnixSocketBus(bus_path)
+    await bus.start(on_bus_message)
     while True:  # Continuous server operation
         try:
             server = await websockets.serve(
@@ -165,8 +424,10 @@ async def start():
                 ping_interval=20,
                 ping_timeout=15,
                 close_timeout=10,
+                compression="deflate",  # permessage-deflate for large serp payloads
+                reuse_port=reuse_port,
             )
-            print("WebSocket server running on ws://0.0.0.0:12345")
+            print(f"WebSocket server running on ws://0.0.0.0:12345, pid {os.getpid()}")
             asyncio.create_task(heartbeat())
             # asyncio.create_task(periodic_sender())
             await server.wait_closed()
@@ -175,6 +436,46 @@ async def start():
             await asyncio.sleep(5)
 
 
+def run_workers(workers, setup=None, bus_path=BUS_PATH):
+    """
+    Serve with several processes on the same port, requires SO_REUSEPORT (Linux).
+    Broadcasts and session results are relayed between workers by the bus hub.
+    The OpenAI rate limits are split evenly between the workers.
+    setup: picklable function called in each worker before serving, e.g. to set the callbacks
+    """
+    if os.path.exists(bus_path):
+        os.remove(bus_path)  # left by a previous run
+    hub = multiprocessing.Process(target=hub_main, args=(bus_path,), daemon=True)
+    hub.start()
+    for _ in range(50):  # wait until the hub is listening
+        if os.path.exists(bus_path):
+            break
+        time.sleep(0.1)
+
+    processes = [
+        multiprocessing.Process(target=worker_main, args=(setup, bus_path, workers))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    print(f"{workers} workers started")
+    for process in processes:
+        process.join()
+    hub.terminate()
+
+
+def hub_main(bus_path):
+    asyncio.run(run_hub(bus_path))
+
+
+def worker_main(setup, bus_path, workers=1):
+    # The workers share the OpenAI account, each one gets an equal part of its limits
+    openai_scheduler.share(workers)
+    if setup:
+        setup()
+    asyncio.run(start(reuse_port=True, bus_path=bus_path))
+
+
 def log_request_count():
     for key in request_type:
         log.info(f"{key} request count: {request_type[key]}")
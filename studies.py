@@ -0,0 +1,168 @@
+import asyncio
+import logging as log
+from collections import OrderedDict
+
+from VideoHandler import VideoHandler
+
+MEMORY_BUDGET = 256 * 1024 * 1024  # bytes of loaded video handlers before eviction
+
+
+class StudyServer:
+    """
+    Serve all studies of backend_study_setting.json from one process.
+    Each client picks a study when it connects, the video handler of a study
+    is loaded on its first client and the least recently used handlers without
+    clients are evicted once the loaded handlers exceed the memory budget.
+    """
+
+    def __init__(self, settings, recommender, default_study=0, memory_budget=MEMORY_BUDGET):
+        """
+        settings: list of study settings, with "title" and "transcript"
+        recommender: ChatRecommender shared by the studies, see ChatRecommender.for_study
+        default_study: study of clients that do not choose one
+        memory_budget: bytes, estimated with VideoHandler.memory_size
+        """
+        self.settings = settings
+        self.recommender = recommender
+        self.default_study = default_study
+        self.memory_budget = memory_budget
+        self.handlers = OrderedDict()  # study -> VideoHandler, least recently used first
+        self.loading = {}  # study -> future of the handler being loaded
+        self.client_study = {}  # client -> study
+        self.loads = 0
+        self.evictions = 0
+
+    def select(self, client, study=None):
+        """
+        Bind a client to a study, the default study if the choice is missing or invalid.
+        The study starts loading in the background, requests wait for it.
+        return: the study number of the client
+        """
+        try:
+            study = int(study)
+            assert 0 <= study < len(self.settings)
+        except (TypeError, ValueError, AssertionError):
+            if study is not None:
+                print(f"Unknown study {study}, use study {self.default_study}")
+            study = self.default_study
+        previous = self.client_study.get(client)
+        if previous is not None and previous != study and previous in self.handlers:
+            self.handlers[previous].remove_client(client)
+        self.client_study[client] = study
+        if study not in self.handlers:
+            self.start_load(study)  # load it now, not on the first request
+        return study
+
+    async def handler(self, study):
+        """
+        return: VideoHandler of the study, loaded if needed
+        raise: the error of loading the study, e.g. a missing transcript
+        """
+        handler = self.handlers.get(study)
+        if handler is not None:
+            self.handlers.move_to_end(study)
+            return handler
+        return await asyncio.shield(self.start_load(study))
+
+    def start_load(self, study):
+        """
+        return: future of the VideoHandler, concurrent loads of a study share it
+        """
+        loading = self.loading.get(study)
+        if loading is None:
+            # Hashing and maybe compiling the transcript would block the event loop
+            loading = asyncio.get_running_loop().run_in_executor(None, self.load, study)
+            self.loading[study] = loading
+            loading.add_done_callback(lambda future: self.loaded(study, future))
+        return loading
+
+    def loaded(self, study, future):
+        # Loaded or failed, a failed study is loaded again on the next call
+        self.loading.pop(study, None)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            print(f"Loading study {study} failed: {future.exception()!r}")
+            return
+        self.handlers[study] = future.result()
+        self.loads += 1
+        self.evict()
+
+    def load(self, study):
+        setting = self.settings[study]
+        print(f"Loading study {study}, the current city is {setting['city']}")
+        recommender = self.recommender.for_study({"<title>": setting["title"]})
+        return VideoHandler(recommender, setting["transcript"])
+
+    async def handler_of(self, client):
+        study = self.client_study.get(client)
+        if study is None:
+            study = self.select(client)
+        return await self.handler(study)
+
+    def memory_size(self):
+        return sum(handler.memory_size() for handler in self.handlers.values())
+
+    def evict(self):
+        """
+        Unload least recently used handlers until the budget is met,
+        handlers of connected clients and the last used one are kept
+        """
+        in_use = set(self.client_study.values())
+        for study in list(self.handlers)[:-1]:
+            if self.memory_size() <= self.memory_budget:
+                return
+            if study in in_use:
+                continue
+            del self.handlers[study]
+            self.evictions += 1
+            log.info(f"Study {study} evicted")
+        if len(self.handlers) > 1 and self.memory_size() > self.memory_budget:
+            print("Loaded studies exceed the memory budget, all are in use")
+
+    async def request_widgets(self, client, text_input, on_item=None, deadline=None):
+        recommender = (await self.handler_of(client)).recommender
+        return await recommender.request_widgets(
+            text_input, on_item=on_item, deadline=deadline
+        )
+
+    async def request_serp(self, client, text_input, deadline=None):
+        recommender = (await self.handler_of(client)).recommender
+        return await recommender.request_serp(text_input, deadline=deadline)
+
+    async def request_serper(self, client, text_input, on_item=None, deadline=None):
+        recommender = (await self.handler_of(client)).recommender
+        return await recommender.request_serper(
+            text_input, on_item=on_item, deadline=deadline
+        )
+
+    async def request_keywords(self, client, current_time, deadline=None):
+        handler = await self.handler_of(client)
+        return await handler.request_keywords(current_time, deadline=deadline)
+
+    def update_progress(self, client, data):
+        """
+        Prefetch for the client, skipped until its study is loaded
+        """
+        handler = self.handlers.get(self.client_study.get(client))
+        if handler is not None:
+            handler.update_progress(client, data)
+
+    def remove_client(self, client):
+        study = self.client_study.pop(client, None)
+        if study in self.handlers:
+            self.handlers[study].remove_client(client)
+        self.evict()
+
+    def stats(self):
+        return {
+            "loaded": list(self.handlers),
+            "clients": len(self.client_study),
+            "memory": self.memory_size(),
+            "budget": self.memory_budget,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "keywords": {
+                str(study): handler.stats() for study, handler in self.handlers.items()
+            },
+        }
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+from bisect import bisect_right
+from functools import reduce
+
+import webvtt
+
+MAGIC = b"VTTIDX01"
+# magic, sha256 of the vtt, number of captions, length of the text blob
+HEADER = struct.Struct("<8s32sQQ")
+
+
+def to_ms(string_time):
+    """
+    Time string in format %H:%M:%S or %H:%M:%S.%f to integer milliseconds
+    """
+    clock, _, fraction = string_time.partition(".")
+    hours, minutes, seconds = clock.split(":")
+    milliseconds = int((fraction + "000")[:3]) if fraction else 0
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + milliseconds
+
+
+def format_ms(time_ms):
+    seconds, milliseconds = divmod(time_ms, 1000)
+    return f"{seconds // 3600:02d}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d}.{milliseconds:03d}"
+
+
+class IntervalIndex:
+    """
+    Binary search over spans sorted by start, with integer millisecond bounds.
+    max_ends[i] is the latest end of spans 0..i, so the search for overlapping
+    spans stops as soon as no earlier span can reach the time.
+    """
+
+    def __init__(self, starts, ends, max_ends=None):
+        """
+        starts, ends: bounds of the spans in milliseconds, sorted by start
+        max_ends: prefix maximum of ends, computed if not given
+        """
+        self.starts = starts
+        self.ends = ends
+        self.max_ends = max_ends if max_ends is not None else self.prefix_max(ends)
+
+    @classmethod
+    def from_spans(cls, spans):
+        """
+        spans: TimeSpan list sorted by start
+        """
+        return cls([span.start_ms for span in spans], [span.end_ms for span in spans])
+
+    @staticmethod
+    def prefix_max(ends):
+        max_ends = []
+        latest = -1
+        for end in ends:
+            latest = max(latest, end)
+            max_ends.append(latest)
+        return max_ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, time_ms, max_gap=0):
+        """
+        return: position of the latest started span containing the time,
+        in a gap the previous span if it ended at most max_gap ago, else None
+        """
+        last = bisect_right(self.starts, time_ms) - 1
+        position = last
+        while position >= 0 and self.max_ends[position] >= time_ms:
+            if self.ends[position] >= time_ms:
+                return position
+            position -= 1
+        if last >= 0 and time_ms - self.max_ends[last] <= max_gap:
+            # The span that ended last before the gap
+            position = last
+            while self.ends[position] != self.max_ends[last]:
+                position -= 1
+            return position
+        return None
+
+    def find_all(self, time_ms):
+        """
+        return: positions of all spans containing the time, latest started first
+        """
+        positions = []
+        position = bisect_right(self.starts, time_ms) - 1
+        while position >= 0 and self.max_ends[position] >= time_ms:
+            if self.ends[position] >= time_ms:
+                positions.append(position)
+            position -= 1
+        return positions
+
+
+def clean_text(text):
+    """
+    Join the lines of a caption and remove &nbsp;
+    """
+    return reduce(lambda x, y: x.strip() + " " + y.strip(), text.split("&nbsp;"))
+
+
+def sidecar_path(vtt_path):
+    return vtt_path + ".idx"
+
+
+class CompiledTranscript:
+    """
+    Captions of a vtt file as arrays, compiled once into a sidecar file next to the vtt
+    and memory mapped, so loading does not parse the vtt or create an object per caption.
+    Layout after HEADER: starts, ends, max_ends as int64 ms, n + 1 int64 text offsets,
+    then the utf-8 texts of all captions, sorted by start.
+    """
+
+    def __init__(self, buffer):
+        """
+        buffer: bytes or mmap of a compiled transcript
+        """
+        self.buffer = buffer
+        view = memoryview(buffer)
+        _, self.digest, count, _ = HEADER.unpack_from(view)
+        arrays = view[HEADER.size : HEADER.size + 8 * (4 * count + 1)].cast("q")
+        self.starts = arrays[:count]
+        self.ends = arrays[count : 2 * count]
+        self.max_ends = arrays[2 * count : 3 * count]
+        self.offsets = arrays[3 * count :]
+        self.blob = view[HEADER.size + 8 * (4 * count + 1) :]
+        self.index = IntervalIndex(self.starts, self.ends, self.max_ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def text(self, position):
+        return str(self.blob[self.offsets[position] : self.offsets[position + 1]], "utf-8")
+
+    @classmethod
+    def load(cls, vtt_path):
+        """
+        Map the sidecar of the vtt, compile it first if missing or made from other content
+        """
+        with open(vtt_path, "rb") as file:
+            digest = hashlib.sha256(file.read()).digest()
+        path = sidecar_path(vtt_path)
+        try:
+            with open(path, "rb") as file:
+                buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, sidecar_digest, _, _ = HEADER.unpack_from(buffer)
+            if magic == MAGIC and sidecar_digest == digest:
+                return cls(buffer)
+            buffer.close()
+        except (OSError, ValueError, struct.error):
+            pass  # missing, empty or truncated sidecar
+
+        data = compile_vtt(vtt_path, digest)
+        try:
+            # Write then rename, other processes never map a partial file
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Cannot write transcript cache {path}: {e}")
+            return cls(data)
+        print(f"Compiled transcript cache {path}")
+        with open(path, "rb") as file:
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def compile_vtt(vtt_path, digest):
+    """
+    return: bytes of the compiled transcript, see CompiledTranscript
+    """
+    captions = sorted(
+        (to_ms(caption.start), to_ms(caption.end), clean_text(caption.text))
+        for caption in webvtt.read(vtt_path)
+    )
+    texts = [text.encode("utf-8") for _, _, text in captions]
+    offsets = [0]
+    for text in texts:
+        offsets.append(offsets[-1] + len(text))
+    starts = [start for start, _, _ in captions]
+    ends = [end for _, end, _ in captions]
+    arrays = starts + ends + IntervalIndex.prefix_max(ends) + offsets
+    return b"".join(
+        [
+            HEADER.pack(MAGIC, digest, len(captions), offsets[-1]),
+            struct.pack(f"<{len(arrays)}q", *arrays),
+        ]
+        + texts
+    )
+
+
+def keywords_path(vtt_path):
+    return vtt_path + ".keywords.json"
+
+
+def load_keywords(vtt_path, digest, prompt_hash):
+    """
+    Precomputed keywords of the captions, see precompute_keywords.py
+    digest: sha256 of the vtt, the sidecar is ignored if made from other content
+    prompt_hash: hash of the video prompt, the sidecar is ignored if made with another prompt
+    return: caption position -> keywords, empty if there is no valid sidecar
+    """
+    try:
+        with open(keywords_path(vtt_path), "r", encoding="utf-8") as file:
+            sidecar = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    if sidecar.get("digest") != digest.hex() or sidecar.get("prompt") != prompt_hash:
+        print(f"Precomputed keywords of {vtt_path} are outdated, not used")
+        return {}
+    return {
+        position: [{"keyword": keyword} for keyword in keywords]
+        for position, keywords in enumerate(sidecar["keywords"])
+        if keywords is not None
+    }
+
+
+def save_keywords(vtt_path, digest, prompt_hash, count, keywords):
+    """
+    Write the keyword sidecar, one list of keyword strings per caption, null if missing
+    keywords: caption position -> keywords
+    """
+    path = keywords_path(vtt_path)
+    sidecar = {
+        "digest": digest.hex(),
+        "prompt": prompt_hash,
+        "keywords": [
+            [item["keyword"] for item in keywords[position]]
+            if position in keywords
+            else None
+            for position in range(count)
+        ],
+    }
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(sidecar, file, ensure_ascii=False, separators=(",", ":"))
+    os.replace(temp_path, path)
@@ -36,8 +36,212 @@ def extract_json_array(text):
     return json
 
 
+def extract_json_object(text):
+    json = re.search(r"\{[\s\S]*\}", text).group()
+    return json
+
+
 def save_note(note_json):
     file_name = datetime.datetime.fromtimestamp(note_json["date"] // 1000)
     path = os.path.join("./notes", f"{file_name}.json")
     with open(path, "w+") as file:
         json.dump(note_json, file, indent=4)
+
+
+class JsonArrayStream:
+    """
+    Incremental parser for a json array of objects in streamed text,
+    each object is returned as soon as it is complete
+    """
+
+    def __init__(self):
+        self.depth = 0  # 0 outside the array, 1 inside the array, >1 inside an object
+        self.in_string = False
+        self.escape = False
+        self.item = []  # characters of the current object
+        self.done = False
+
+    def feed(self, text):
+        """
+        text: next chunk of the streamed text
+        return: list of objects completed in this chunk
+        """
+        items = []
+        for char in text:
+            if self.done:
+                break
+            if self.depth >= 2:
+                self.item.append(char)
+                if self.in_string:
+                    if self.escape:
+                        self.escape = False
+                    elif char == "\\":
+                        self.escape = True
+                    elif char == '"':
+                        self.in_string = False
+                elif char == '"':
+                    self.in_string = True
+                elif char in "{[":
+                    self.depth += 1
+                elif char in "}]":
+                    self.depth -= 1
+                    if self.depth == 1:
+                        items.append(json.loads("".join(self.item)))
+                        self.item = []
+            elif self.depth == 1:
+                if char == "{":
+                    self.depth = 2
+                    self.item = [char]
+                elif char == "]":
+                    self.done = True
+                elif not (char.isspace() or char == ","):
+                    self.depth = 0  # the bracket was not the start of an array of objects
+            elif char == "[":
+                self.depth = 1
+        return items
+
+
+JSON_DECODER = json.JSONDecoder()
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class JsonProjection:
+    """
+    Incremental parser keeping only some top level fields of a streamed json object.
+    Values of other fields are decoded and dropped without building the whole
+    document, and parsing stops once all fields are complete.
+    """
+
+    def __init__(self, fields, optional=()):
+        """
+        fields: key -> number of array entries to keep, None to keep the whole value
+        optional: keys kept if present, not waited for, e.g. "error"
+        """
+        self.fields = fields
+        self.optional = set(optional)
+        self.result = {}
+        self.missing = set(fields)
+        self.buffer = ""
+        self.pos = 0
+        self.state = "start"  # start, key, colon, value, array, entries
+        self.key = None
+        self.retry_at = 0  # buffer length to reach before decoding a value again
+        self.ended = False  # the whole text was fed
+        self.done = False
+
+    def feed(self, text):
+        """
+        text: next chunk of the streamed text
+        return: True once all fields are complete or the object has ended
+        """
+        self.buffer += text
+        while not self.done and self.step():
+            pass
+        if self.pos > 1 << 16:  # drop the parsed text
+            self.buffer = self.buffer[self.pos :]
+            self.retry_at = max(0, self.retry_at - self.pos)
+            self.pos = 0
+        return self.done
+
+    def finish(self):
+        """
+        Parse what is left once the stream ended, e.g. a value postponed by retry_at
+        return: the projected object
+        raise: ValueError if the text ended before the object
+        """
+        self.ended = True
+        while not self.done and self.step():
+            pass
+        if not self.done:
+            raise ValueError(f"Incomplete json object, {self.state} at {self.pos}")
+        return self.result
+
+    def next_char(self):
+        self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+        return self.buffer[self.pos] if self.pos < len(self.buffer) else None
+
+    def decode(self):
+        """
+        return: (True, value) for a complete value at pos, (False, None) if more text is needed
+        """
+        if len(self.buffer) < self.retry_at and not self.ended:
+            return False, None
+        try:
+            value, end = JSON_DECODER.raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError:
+            end = len(self.buffer)
+        # A number at the end of the buffer may continue in the next chunk
+        if end >= len(self.buffer):
+            # Wait until the text doubles, a large value is not decoded once per chunk
+            self.retry_at = self.pos + 2 * (len(self.buffer) - self.pos)
+            return False, None
+        self.pos = end
+        self.retry_at = 0
+        return True, value
+
+    def complete(self, key):
+        self.missing.discard(key)
+        if not self.missing:
+            self.done = True
+
+    def step(self):
+        """
+        Parse the next token
+        return: False if more text is needed
+        """
+        char = self.next_char()
+        if char is None:
+            return False
+        if self.state == "start":
+            if char != "{":
+                raise ValueError(f"Expected json object at {self.pos}")
+            self.pos += 1
+            self.state = "key"
+        elif self.state == "key":
+            if char == "}":
+                self.done = True
+            elif char == ",":
+                self.pos += 1
+            else:
+                found, self.key = self.decode()
+                if not found:
+                    return False
+                self.state = "colon"
+        elif self.state == "colon":
+            if char != ":":
+                raise ValueError(f"Expected colon at {self.pos}")
+            self.pos += 1
+            limit = self.fields.get(self.key)
+            self.state = "array" if limit is not None else "value"
+        elif self.state == "value":
+            found, value = self.decode()
+            if not found:
+                return False
+            if self.key in self.fields or self.key in self.optional:
+                self.result[self.key] = value
+                self.complete(self.key)
+            self.state = "key"
+        elif self.state == "array":
+            if char != "[":
+                self.state = "value"  # not an array, keep the whole value
+                return True
+            self.pos += 1
+            self.result[self.key] = []
+            self.state = "entries"
+        elif self.state == "entries":
+            entries = self.result[self.key]
+            if char == "]":
+                self.pos += 1
+                self.state = "key"
+                self.complete(self.key)
+            elif char == ",":
+                self.pos += 1
+            else:
+                found, value = self.decode()
+                if not found:
+                    return False
+                if len(entries) < self.fields[self.key]:
+                    entries.append(value)
+                if len(entries) == self.fields[self.key]:
+                    self.complete(self.key)
+        return True